@@ -0,0 +1,282 @@
+"""Time data processing hot paths of photodiag_web panels on synthetic data.
+
+Usage: python benchmarks/run.py [--only NAME] [--min-time SECONDS]
+"""
+
+import argparse
+import time
+from copy import deepcopy
+
+import numpy as np
+from synthetic import pbps_diodes, pbps_positions, psss_spectra
+
+from photodiag_web import (
+    PowerSpectrumAccumulator,
+    RingBuffer,
+    fit_autocorr,
+    mean_autocorrelation,
+)
+from photodiag_web.app.panel_calibration import calibrate_norm, shot_norm_diff
+from photodiag_web.app.panel_correlation import normalize_values
+from photodiag_web.app.panel_diode_check import normalize_by_i0
+from photodiag_web.app.panel_spect_autocorr import FWHM_TO_SIGMA
+from photodiag_web.app.panel_spect_int_corr import (
+    NUM_I0_BINS,
+    SpectraI0Accumulator,
+    pearson_1D,
+    spectra_bin_I0,
+)
+from photodiag_web.app.panel_spect_peaks import PEAKS_BATCH_SIZE, count_peaks, process_spectrum
+from photodiag_web.autocorr import model
+from photodiag_web.stats import RollingStats
+
+NUM_PIXELS = (1024, 2560)
+BUFFER_SIZES = (100, 1000, 5000)
+
+benchmarks = {}
+
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+
+def measure(func, shots_per_call, min_time, max_calls=10_000):
+    """Call func repeatedly for at least min_time seconds.
+
+    Returns:
+        dict: shots per second and latency percentiles of a single call in ms
+    """
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < max_calls and time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t0)
+
+    latencies = np.array(latencies)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+    return dict(
+        calls=len(latencies),
+        shots_per_s=shots_per_call / latencies.mean(),
+        p50=p50,
+        p90=p90,
+        p99=p99,
+    )
+
+
+@benchmark
+def pearson(rng, min_time):
+    for num_pixels in NUM_PIXELS:
+        for num_shots in BUFFER_SIZES:
+            _, spectra, i0 = psss_spectra(num_shots, num_pixels, rng)
+            yield (num_pixels, num_shots), measure(
+                lambda: pearson_1D(spectra, i0), num_shots, min_time
+            )
+
+
+@benchmark
+def bin_I0(rng, min_time):
+    for num_pixels in NUM_PIXELS:
+        for num_shots in BUFFER_SIZES:
+            _, spectra, i0 = psss_spectra(num_shots, num_pixels, rng)
+            bins = np.linspace(i0.min(), i0.max(), NUM_I0_BINS, endpoint=False)
+            yield (num_pixels, num_shots), measure(
+                lambda: spectra_bin_I0(i0, bins, spectra), num_shots, min_time
+            )
+
+
+@benchmark
+def int_corr_accumulator(rng, min_time):
+    for num_pixels in NUM_PIXELS:
+        for num_shots in BUFFER_SIZES:
+            _, spectra, i0 = psss_spectra(200, num_pixels, rng)
+            accumulator = SpectraI0Accumulator(num_shots)
+            shots = iter(range(10**9))
+
+            def add():
+                ind = next(shots) % len(i0)
+                accumulator.add(spectra[ind], i0[ind])
+
+            yield (num_pixels, num_shots, "add"), measure(add, 1, min_time)
+            yield (num_pixels, num_shots, "get"), measure(accumulator.get, num_shots, min_time)
+
+
+@benchmark
+def spect_peaks(rng, min_time):
+    for num_pixels in NUM_PIXELS:
+        _, spectra, _ = psss_spectra(200, num_pixels, rng)
+        shots = iter(range(10**9))
+
+        def process():
+            process_spectrum(spectra[next(shots) % len(spectra)], 100, 100, 0.002)
+
+        yield (num_pixels,), measure(process, 1, min_time)
+
+
+@benchmark
+def spect_peaks_batch(rng, min_time):
+    for num_pixels in NUM_PIXELS:
+        _, spectra, _ = psss_spectra(PEAKS_BATCH_SIZE, num_pixels, rng)
+        # ADC-like integer spectra with flat tops and many equal gradient values
+        adc_spectra = np.round(np.clip(spectra / spectra.max(), 0, 0.5) * 4095)
+        for name, data in (("float", spectra), ("adc", adc_spectra)):
+            for kernel_size in (10, 100, 1000):
+                counts = [len(process_spectrum(y, kernel_size, 100, 0.002)[3]) for y in data]
+                if not np.array_equal(count_peaks(data, kernel_size, 100, 0.002), counts):
+                    raise RuntimeError("count_peaks differs from process_spectrum")
+
+                yield (num_pixels, name, kernel_size), measure(
+                    lambda: count_peaks(data, kernel_size, 100, 0.002), PEAKS_BATCH_SIZE, min_time
+                )
+
+
+@benchmark
+def autocorr(rng, min_time):
+    for num_pixels in NUM_PIXELS:
+        for num_shots in BUFFER_SIZES:
+            _, spectra, _ = psss_spectra(num_shots, num_pixels, rng)
+            yield (num_pixels, num_shots), measure(
+                lambda: mean_autocorrelation(spectra), num_shots, min_time
+            )
+
+
+@benchmark
+def autocorr_accumulator(rng, min_time):
+    for num_pixels in NUM_PIXELS:
+        for num_shots in BUFFER_SIZES:
+            _, spectra, _ = psss_spectra(200, num_pixels, rng)
+            accumulator = PowerSpectrumAccumulator(num_shots)
+            shots = iter(range(10**9))
+
+            def add():
+                accumulator.add(spectra[next(shots) % len(spectra)])
+
+            yield (num_pixels, num_shots, "add"), measure(add, 1, min_time)
+            yield (num_pixels, num_shots, "get"), measure(
+                accumulator.mean_autocorrelation, num_shots, min_time
+            )
+
+
+@benchmark
+def autocorr_fit(rng, min_time):
+    params = model.make_params(
+        g0_sigma=dict(value=12, min=0.05),
+        g0_center=dict(value=0, vary=False),
+        g0_amplitude=dict(value=1, min=0),
+        g1_sigma=dict(value=6, min=0.05),
+        g1_center=dict(value=0, vary=False),
+        g1_amplitude=dict(value=1, min=0),
+        g2_sigma=dict(value=1.4 * FWHM_TO_SIGMA, min=0.05),
+        g2_center=dict(value=0, vary=False),
+        g2_amplitude=dict(value=1, min=0),
+    )
+    for num_pixels in NUM_PIXELS:
+        spec_x, spectra, _ = psss_spectra(1000, num_pixels, rng)
+        y_autocorr = mean_autocorrelation(spectra)
+        y_autocorr /= np.max(y_autocorr)
+        lags = spec_x - spec_x[num_pixels // 2]
+
+        yield (num_pixels,), measure(
+            lambda: fit_autocorr(y_autocorr, lags, deepcopy(params)), 1, min_time, max_calls=50
+        )
+
+
+@benchmark
+def correlation_normalize(rng, min_time):
+    for num_shots in BUFFER_SIZES:
+        values = np.concatenate(
+            (pbps_positions(1000, rng), pbps_positions(1000, rng)), axis=1
+        ).tolist()
+        buffer = RingBuffer(num_shots, num_columns=7)
+        shots = iter(range(10**9))
+
+        def process():
+            pulse_id = next(shots)
+            normalized = normalize_values(values[pulse_id % len(values)])
+            buffer.append((pulse_id % 2, *normalized))
+
+        yield (num_shots,), measure(process, 1, min_time)
+
+
+@benchmark
+def diode_check_normalize(rng, min_time):
+    for num_shots in BUFFER_SIZES:
+        values = pbps_diodes(1000, rng).tolist()
+        buffer = RingBuffer(num_shots, num_columns=4)
+        shots = iter(range(10**9))
+
+        def process():
+            buffer.append(normalize_by_i0(values[next(shots) % len(values)], 0))
+
+        yield (num_shots,), measure(process, 1, min_time)
+
+
+@benchmark
+def rolling_stats(rng, min_time):
+    # a jitter panel refresh after 100 new shots (1 s at 100 Hz)
+    num_new = 100
+    for num_shots in BUFFER_SIZES:
+        values = pbps_positions(1000, rng)
+        buffer = RingBuffer(num_shots, num_columns=4)
+        stats = RollingStats(pairs=((1, 2), (3, 1), (3, 2)))
+        shots = iter(range(10**9))
+
+        def update():
+            for _ in range(num_new):
+                pulse_id = next(shots)
+                buffer.append((pulse_id % 2, *values[pulse_id % len(values)]))
+            stats.update(buffer)
+            for ind in range(3):
+                stats.get(ind, 0)
+                stats.get(ind, 1)
+
+        yield (num_shots,), measure(update, num_new, min_time)
+
+
+@benchmark
+def calibration(rng, min_time):
+    for num_points in (3, 21):
+        for num_shots in (500, 5000):
+            I_all = pbps_diodes(num_shots, rng).T
+            x_all = np.stack([pbps_diodes(num_shots, rng).T for _ in range(num_points)])
+            y_all = np.stack([pbps_diodes(num_shots, rng).T for _ in range(num_points)])
+
+            def calibrate():
+                I_norm, *_ = calibrate_norm(
+                    I_all.mean(axis=-1),
+                    I_all.std(axis=-1),
+                    x_all.mean(axis=-1),
+                    x_all.std(axis=-1),
+                    y_all.mean(axis=-1),
+                    y_all.std(axis=-1),
+                )
+                shot_norm_diff(x_all[:, 3], x_all[:, 2], *I_norm[[3, 2]])
+                shot_norm_diff(y_all[:, 1], y_all[:, 0], *I_norm[[1, 0]])
+
+            num_shots_total = (2 * num_points + 1) * num_shots
+            yield (num_points, num_shots), measure(calibrate, num_shots_total, min_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks), help="benchmarks to run")
+    parser.add_argument("--min-time", type=float, default=1, help="seconds per case (default: 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(
+        f"{'benchmark':<24}{'case':<24}{'calls':>8}{'shots/s':>14}"
+        f"{'p50 [ms]':>10}{'p90 [ms]':>10}{'p99 [ms]':>10}"
+    )
+    for name in args.only or benchmarks:
+        for case, res in benchmarks[name](rng, args.min_time):
+            print(
+                f"{name:<24}{str(case):<24}{res['calls']:>8}{res['shots_per_s']:>14.0f}"
+                f"{res['p50']:>10.3f}{res['p90']:>10.3f}{res['p99']:>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
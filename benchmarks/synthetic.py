@@ -0,0 +1,46 @@
+"""Synthetic PBPS and PSSS data for benchmarks."""
+
+import numpy as np
+
+PSSS_CENTER = 9000  # eV
+PBPS_DIODE_LEVEL = 1.0
+
+
+def pbps_diodes(num_shots, rng):
+    """Return diode signals (down, up, right, left) of a PBPS, shape (num_shots, 4)."""
+    i0 = rng.gamma(20, PBPS_DIODE_LEVEL / 20, size=(num_shots, 1))
+    return i0 * rng.normal(1, 0.05, size=(num_shots, 4))
+
+
+def pbps_positions(num_shots, rng):
+    """Return x, y positions and intensities of a PBPS, shape (num_shots, 3)."""
+    x = rng.normal(0, 0.05, num_shots)
+    y = rng.normal(0, 0.05, num_shots)
+    i = rng.gamma(20, 1 / 20, num_shots)
+    return np.stack((x, y, i), axis=1)
+
+
+def psss_spectra(num_shots, num_pixels, rng, num_spikes=30):
+    """Return SASE-like spiky spectra and their intensities.
+
+    Returns:
+        tuple: spectrum x axis (num_pixels,), spectra (num_shots, num_pixels), I0 (num_shots,)
+    """
+    spec_x = np.linspace(PSSS_CENTER - 50, PSSS_CENTER + 50, num_pixels)
+    pixels = np.arange(num_pixels)
+
+    envelope = np.exp(-0.5 * ((pixels - num_pixels / 2) / (num_pixels / 8)) ** 2)
+    centers = rng.normal(num_pixels / 2, num_pixels / 8, size=(num_shots, num_spikes, 1))
+    amplitudes = rng.exponential(1, size=(num_shots, num_spikes, 1))
+    width = num_pixels / 500
+
+    spectra = np.zeros((num_shots, num_pixels))
+    for shot_centers, shot_amplitudes, spectrum in zip(centers, amplitudes, spectra):
+        spectrum += np.sum(
+            shot_amplitudes * np.exp(-0.5 * ((pixels - shot_centers) / width) ** 2), 0
+        )
+
+    spectra = spectra * envelope + rng.normal(0, 0.01, size=spectra.shape)
+    i0 = spectra.sum(axis=1) * rng.normal(1, 0.02, num_shots)
+
+    return spec_x, spectra, i0
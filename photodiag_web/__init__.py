@@ -1,3 +1,19 @@
 from photodiag_web.utils import *
+from photodiag_web.stream_hub import StreamHub, stream_hub
+from photodiag_web.autocorr import (
+    PowerSpectrumAccumulator,
+    autocorrelate,
+    fit_autocorr,
+    mean_autocorrelation,
+)
+from photodiag_web.density import RollingHistogram2D, density_rgba
+from photodiag_web.elog_publisher import ELOG_URL, ElogPublisher, elog_publisher, push_elog
+from photodiag_web.fit_service import FitService, fit_service
+from photodiag_web.fwhm_monitor import FwhmMonitor, fwhm_monitor
+from photodiag_web.metrics import PanelStats, render_metrics
+from photodiag_web.pipeline_configs import PipelineConfigCache, pipeline_configs
+from photodiag_web.replay import ReplaySource, StreamRecorder, record
+from photodiag_web.scan import MotorPositioner, PVPositioner, scan
+from photodiag_web.stats import PairStats, RollingStats, format_stats
 
 __version__ = "0.3.0"
@@ -1,3 +1,24 @@
+import os
+from functools import partial
+
+from photodiag_web import DEVICES, pipeline_configs, stream_hub
+from photodiag_web.metrics import start_metrics_server
+from photodiag_web.replay import ReplaySource
+
+
+def on_server_loaded(_server_context):
+    replay_file = os.environ.get("PHOTODIAG_WEB_REPLAY")
+    if replay_file:
+        rate = float(os.environ.get("PHOTODIAG_WEB_REPLAY_RATE", 0))
+        stream_hub.source_factory = partial(ReplaySource, replay_file, rate=rate or None)
+
+    pipeline_configs.prefetch([device + "_proc" for device in DEVICES])
+
+    metrics_port = os.environ.get("PHOTODIAG_WEB_METRICS_PORT")
+    if metrics_port:
+        start_metrics_server(int(metrics_port))
+
+
 def on_session_destroyed(session_context):
     for pv in session_context._document.pvs:
         pv.disconnect()
@@ -1,19 +1,22 @@
 import logging
+from functools import partial
 from io import StringIO
 
 from bokeh.io import curdoc
 from bokeh.layouts import column
-from bokeh.models import Div, TabPanel, Tabs, TextAreaInput
+from bokeh.models import Div, Spacer, TabPanel, Tabs, TextAreaInput
 
 from photodiag_web.app import (
     panel_calibration,
     panel_correlation,
     panel_diode_check,
     panel_jitter,
+    panel_jitter_overview,
     panel_spect_autocorr,
     panel_spect_int_corr,
     panel_spect_peaks,
 )
+from photodiag_web.app.refresh_scheduler import RefreshScheduler
 
 doc = curdoc()
 doc.title = "photodiag-web"
@@ -27,45 +30,94 @@ handler.setFormatter(
 logger = logging.getLogger(str(id(doc)))
 logger.setLevel(logging.INFO)
 logger.addHandler(handler)
-# Add logger before creating panels!
+# Add logger and refresh scheduler before creating panels!
 doc.logger = logger
+doc.refresh_scheduler = RefreshScheduler(doc)
 
 log_textareainput = TextAreaInput(title="logging output:", height=150, width=1500)
 
-position_img = Div(text="""<img src="/app/static/aramis.png" width="1000" height="200">""")
-position_tabs = Tabs(
-    tabs=[
-        panel_calibration.create(),
-        panel_correlation.create(),
-        panel_jitter.create(),
-        panel_diode_check.create(),
-    ]
-)
-position_panel = TabPanel(child=column(position_img, position_tabs), title="Position")
-
-spectral_img = Div(text="""<img src="/app/static/sf_spectral.png" width="1000" height="200">""")
-spectral_tabs = Tabs(
-    tabs=[
-        panel_spect_int_corr.create(),
-        panel_spect_peaks.create("Aramis Spectral peaks analysis", ["SARFE10-PSSS059"]),
-        panel_spect_peaks.create(
-            "Athos Spectral peaks analysis", ["SATOP21-PMOS127-2D", "SATOP31-PMOS132-2D"]
-        ),
-        panel_spect_autocorr.create("Aramis/Athos Spectral autocorrelation"),
-    ]
-)
-spectral_panel = TabPanel(child=column(spectral_img, spectral_tabs), title="Spectral")
+
+def _lazy_tabs(panels, **kwargs):
+    """Create Tabs, where each panel is built only when its tab is activated for the first time.
+
+    Args:
+        panels (list): a list of tuples of tab titles and functions returning a TabPanel
+    """
+    tabs = Tabs(tabs=[TabPanel(child=Spacer(), title=title) for title, _ in panels], **kwargs)
+    built = set()
+
+    def build(index):
+        if index in built:
+            return
+
+        built.add(index)
+        _, create = panels[index]
+        tabs.tabs[index].child = create().child
+
+    def active_callback(_attr, _old, new):
+        build(new)
+        doc.refresh_scheduler.update_visibility()
+
+    tabs.on_change("active", active_callback)
+    build(tabs.active)
+
+    return tabs
+
+
+def create_position_panel():
+    position_img = Div(text="""<img src="/app/static/aramis.png" width="1000" height="200">""")
+    position_tabs = _lazy_tabs(
+        [
+            ("calibration", panel_calibration.create),
+            ("correlation", panel_correlation.create),
+            ("jitter", panel_jitter.create),
+            ("jitter overview", panel_jitter_overview.create),
+            ("diode check", panel_diode_check.create),
+        ]
+    )
+    return TabPanel(child=column(position_img, position_tabs), title="Position")
+
+
+def create_spectral_panel():
+    spectral_img = Div(text="""<img src="/app/static/sf_spectral.png" width="1000" height="200">""")
+    spectral_tabs = _lazy_tabs(
+        [
+            ("Aramis Spectral intensity correlation", panel_spect_int_corr.create),
+            (
+                "Aramis Spectral peaks analysis",
+                partial(
+                    panel_spect_peaks.create, "Aramis Spectral peaks analysis", ["SARFE10-PSSS059"]
+                ),
+            ),
+            (
+                "Athos Spectral peaks analysis",
+                partial(
+                    panel_spect_peaks.create,
+                    "Athos Spectral peaks analysis",
+                    ["SATOP21-PMOS127-2D", "SATOP31-PMOS132-2D"],
+                ),
+            ),
+            (
+                "Aramis/Athos Spectral autocorrelation",
+                partial(panel_spect_autocorr.create, "Aramis/Athos Spectral autocorrelation"),
+            ),
+        ]
+    )
+    return TabPanel(child=column(spectral_img, spectral_tabs), title="Spectral")
+
 
 # Final layout
 doc.add_root(
     column(
-        Tabs(
-            tabs=[position_panel, spectral_panel],
+        _lazy_tabs(
+            [("Position", create_position_panel), ("Spectral", create_spectral_panel)],
             stylesheets=[".bk-tab {font-weight: bold; font-size: 20px;}"],
         ),
         log_textareainput,
+        doc.refresh_scheduler.page_visible_toggle,
     )
 )
+doc.refresh_scheduler.update_visibility()
 
 
 def update_stdout():
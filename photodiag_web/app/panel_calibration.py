@@ -7,40 +7,76 @@ import numpy as np
 from bokeh.layouts import column, gridplot, row
 from bokeh.models import Button, ColumnDataSource, Select, Spacer, Spinner, TabPanel, Whisker
 from bokeh.plotting import curdoc, figure
-from cam_server_client import PipelineClient
 from scipy.optimize import curve_fit
-from uncertainties import unumpy
 
-from photodiag_web import DEVICES, epics_collect_data, push_elog
+from photodiag_web import (
+    DEVICES,
+    epics_collect_data,
+    epics_put_many,
+    pipeline_configs,
+    push_elog,
+)
+from photodiag_web.scan import MotorPositioner, scan
 
 scan_x_range = np.linspace(-0.3, 0.3, 3)
 scan_y_range = np.linspace(-0.3, 0.3, 3)
 
-client = PipelineClient()
+SCAN_CHUNK_SIZE = 100
 
 
-def pv_scan(pv_name, scan_range, channels, numShots):
-    motor = epics.Motor(pv_name)
+def collect_adaptive(channels, max_shots, ratio, precision=0, chunk_size=SCAN_CHUNK_SIZE):
+    """Collect shots in chunks until the standard error of a per-shot ratio is below precision.
 
-    scan_mean = []
-    scan_std = []
-    scan_all = []
+    Args:
+        channels (list): channel names
+        max_shots (int): maximum number of shots to collect
+        ratio (callable): function of the collected data, returning per-shot ratios
+        precision (float, optional): target standard error of the mean ratio, if 0, max_shots are
+            collected at once
+        chunk_size (int, optional): number of shots to collect between precision checks
 
-    for pos in scan_range:
-        val = motor.move(pos, wait=True)
-        if val != 0:
-            if val == -12:
-                raise ValueError(f"Motor position outside soft limits: {motor.LLM} {motor.HLM}")
-            raise ValueError(f"Error moving the motor {pv_name}, error value {val}")
+    Returns:
+        tuple: collected data (a list of arrays per channel) and achieved standard error
+    """
+    if precision <= 0:
+        chunk_size = max_shots
 
-        data = epics_collect_data(channels, numShots)
-        scan_mean.append([i.mean() for i in data])
-        scan_std.append([i.std() for i in data])
-        scan_all.append(data)
+    chunks = []
+    num_shots = 0
+    while True:
+        num_chunk_shots = min(chunk_size, max_shots - num_shots)
+        chunks.append(epics_collect_data(channels, num_chunk_shots))
+        num_shots += num_chunk_shots
 
-    motor.move(0, wait=True)
+        data = [np.concatenate(ch_chunks) for ch_chunks in zip(*chunks)]
+        values = ratio(data)
+        std_error = np.std(values) / np.sqrt(len(values))
+        if num_shots >= max_shots or std_error < precision:
+            return data, std_error
 
-    return np.asarray(scan_mean), np.asarray(scan_std), np.asarray(scan_all)
+
+def pv_scan(pv_name, scan_range, channels, numShots, ratio, precision=0):
+    """Scan a motor and collect data at each position.
+
+    See `collect_adaptive` for the description of ratio and precision arguments.
+
+    Returns:
+        tuple: mean and std of channels per position, a list of collected data per position and
+            achieved standard errors of the ratio per position
+    """
+
+    def acquire(_pos):
+        return collect_adaptive(channels, numShots, ratio, precision)
+
+    def analyze(_pos, acquired):
+        data, std_error = acquired
+        data = np.asarray(data)
+        return data.mean(axis=1), data.std(axis=1), data, std_error
+
+    results = scan(MotorPositioner(pv_name), scan_range, acquire, analyze, return_position=0)
+    scan_mean, scan_std, scan_all, scan_precision = zip(*results)
+
+    return np.asarray(scan_mean), np.asarray(scan_std), list(scan_all), np.asarray(scan_precision)
 
 
 def PBPS_I_calibrate(channels, numShots):
@@ -61,10 +97,87 @@ def fit(xdata, ydata):
     return popt
 
 
+def norm_diff(A, A_std, B, B_std, E, E_std, F, F_std):
+    """Compute (A*E-B*F)/(A*E+B*F) with first-order propagation of uncertainties.
+
+    All quantities are treated as independent. Arguments can be scalars or arrays of any
+    broadcastable shapes, e.g. whole scans at once.
+
+    Returns:
+        tuple: value and std of the ratio
+    """
+    a = A * E
+    b = B * F
+    a_var = (E * A_std) ** 2 + (A * E_std) ** 2
+    b_var = (F * B_std) ** 2 + (B * F_std) ** 2
+
+    a_plus_b = a + b
+    value = (a - b) / a_plus_b
+    # d(ratio) = 2 * (b * da - a * db) / (a + b)^2
+    std = 2 * np.sqrt(b**2 * a_var + a**2 * b_var) / a_plus_b**2
+
+    return value, std
+
+
+def shot_ratio(A_shots, B_shots, E, F):
+    """Compute per-shot (A*E-B*F)/(A*E+B*F) ratios."""
+    a = A_shots * E
+    b = B_shots * F
+    return (a - b) / (a + b)
+
+
+def shot_norm_diff(A_shots, B_shots, E, F):
+    """Compute mean and std of per-shot (A*E-B*F)/(A*E+B*F) ratios along the last axis."""
+    ratio = shot_ratio(A_shots, B_shots, E, F)
+    return ratio.mean(axis=-1), ratio.std(axis=-1)
+
+
+def calibrate_norm(I_mean, I_std, x_mean, x_std, y_mean, y_std):
+    """Compute diode calibration and normalized positions with propagated uncertainties.
+
+    Args:
+        I_mean, I_std (ndarray): mean and std of down, up, right and left diode signals
+        x_mean, x_std (ndarray): same, for each horizontal scan position
+        y_mean, y_std (ndarray): same, for each vertical scan position
+
+    Returns:
+        tuple: I_norm, x_norm, x_norm_std, y_norm, y_norm_std
+    """
+    I_norm = 1 / I_mean / 4
+    I_norm_std = I_std / I_mean**2 / 4
+
+    # (left - right) / (left + right)
+    x_norm, x_norm_std = norm_diff(
+        x_mean[:, 3],
+        x_std[:, 3],
+        x_mean[:, 2],
+        x_std[:, 2],
+        I_norm[3],
+        I_norm_std[3],
+        I_norm[2],
+        I_norm_std[2],
+    )
+    # (up - down) / (up + down)
+    y_norm, y_norm_std = norm_diff(
+        y_mean[:, 1],
+        y_std[:, 1],
+        y_mean[:, 0],
+        y_std[:, 0],
+        I_norm[1],
+        I_norm_std[1],
+        I_norm[0],
+        I_norm_std[0],
+    )
+
+    return I_norm, x_norm, x_norm_std, y_norm, y_norm_std
+
+
 def create():
     doc = curdoc()
     log = doc.logger
     config = {}
+    # calibration results, which are not pushed yet
+    results_pending = False
 
     targets_pvs = {}
     in_pos_pvs = {}
@@ -176,7 +289,7 @@ def create():
         doc.add_next_tick_callback(partial(_update_target, char_value))
 
     def device_select_callback(_attr, _old, new):
-        nonlocal config
+        nonlocal config, results_pending
 
         # clear old callbacks
         if config:
@@ -184,7 +297,8 @@ def create():
             targets_pvs[old_device_name].clear_callbacks()
             in_pos_pvs[old_device_name].clear_callbacks()
 
-        config = client.get_pipeline_config(new + "_proc")
+        config = pipeline_configs.get(new + "_proc")
+        results_pending = False
         device_name = _get_device_name()
 
         # get target options
@@ -204,68 +318,87 @@ def create():
     device_select = Select(title="Device:", options=DEVICES)
     device_select.on_change("value", device_select_callback)
 
-    num_shots_spinner = Spinner(title="Number shots:", mode="int", value=500, step=100, low=100)
+    num_shots_spinner = Spinner(
+        title="Number shots (max):", mode="int", value=500, step=100, low=100
+    )
+    precision_spinner = Spinner(
+        title="Target precision:", mode="float", value=0, step=0.001, low=0, format="0[.]0000"
+    )
 
     async def _lock_gui():
         num_shots_spinner.disabled = True
+        precision_spinner.disabled = True
         target_select.disabled = True
         calibrate_button.disabled = True
         push_results_button.disabled = True
 
     async def _unlock_gui():
         num_shots_spinner.disabled = False
+        precision_spinner.disabled = False
         target_select.disabled = False
         calibrate_button.disabled = False
         push_results_button.disabled = False
 
     def _calibrate():
+        nonlocal results_pending
         device_name = _get_device_name()
         numShots = num_shots_spinner.value
+        precision = precision_spinner.value
         channels = [config["down"], config["up"], config["right"], config["left"]]
         calib_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        I_mean, I_std, _ = PBPS_I_calibrate(channels, numShots)
-        u_I = unumpy.uarray(I_mean, I_std)
-        u_I_norm = 1 / u_I / 4
+        try:
+            I_mean, I_std, _ = PBPS_I_calibrate(channels, numShots)
+        except TimeoutError as e:
+            log.error(e)
+            doc.add_next_tick_callback(_unlock_gui)
+            return
+
         log.info(f"Diode response calibrated for {device_name}")
 
+        # per-shot normalized ratios to estimate the precision of scan points
+        I_calib = 1 / I_mean / 4
+
+        def x_ratio(data):
+            return shot_ratio(data[3], data[2], I_calib[3], I_calib[2])
+
+        def y_ratio(data):
+            return shot_ratio(data[1], data[0], I_calib[1], I_calib[0])
+
         pv_x_name = f"{device_name}:MOTOR_X1"
         try:
-            x_mean, x_std, _ = pv_scan(pv_x_name, scan_x_range, channels, numShots)
-        except ValueError as e:
+            x_mean, x_std, x_all, x_precision = pv_scan(
+                pv_x_name, scan_x_range, channels, numShots, x_ratio, precision
+            )
+        except (ValueError, TimeoutError) as e:
             log.error(e)
             doc.add_next_tick_callback(_unlock_gui)
             return
         else:
             log.info(f"Horizontal position calibrated for {device_name}")
 
-        u_x = unumpy.uarray(x_mean, x_std)
-
         pv_y_name = f"{device_name}:MOTOR_Y1"
         try:
-            y_mean, y_std, _ = pv_scan(pv_y_name, scan_y_range, channels, numShots)
-        except ValueError as e:
+            y_mean, y_std, y_all, y_precision = pv_scan(
+                pv_y_name, scan_y_range, channels, numShots, y_ratio, precision
+            )
+        except (ValueError, TimeoutError) as e:
             log.error(e)
             doc.add_next_tick_callback(_unlock_gui)
             return
         else:
             log.info(f"Vertical position calibrated for {device_name}")
 
-        u_y = unumpy.uarray(y_mean, y_std)
-
-        u_x_norm = (u_x[:, 3] * u_I_norm[3] - u_x[:, 2] * u_I_norm[2]) / (
-            u_x[:, 3] * u_I_norm[3] + u_x[:, 2] * u_I_norm[2]
+        I_norm, x_norm, x_norm_std, y_norm, y_norm_std = calibrate_norm(
+            I_mean, I_std, x_mean, x_std, y_mean, y_std
         )
-
-        u_y_norm = (u_y[:, 1] * u_I_norm[1] - u_y[:, 0] * u_I_norm[0]) / (
-            u_y[:, 1] * u_I_norm[1] + u_y[:, 0] * u_I_norm[0]
-        )
-
-        x_norm_std = unumpy.std_devs(u_x_norm)
-        x_norm = unumpy.nominal_values(u_x_norm)
-        y_norm_std = unumpy.std_devs(u_y_norm)
-        y_norm = unumpy.nominal_values(u_y_norm)
-        I_norm = unumpy.nominal_values(u_I_norm)
+        # statistics of per-shot ratios, number of shots can differ between scan points
+        x_shot_norm, x_shot_norm_std = np.array(
+            [shot_norm_diff(data[3], data[2], I_norm[3], I_norm[2]) for data in x_all]
+        ).T
+        y_shot_norm, y_shot_norm_std = np.array(
+            [shot_norm_diff(data[1], data[0], I_norm[1], I_norm[0]) for data in y_all]
+        ).T
 
         # Update config
         config["down_calib"] = I_norm[0]
@@ -277,10 +410,17 @@ def create():
         config["calib_x_range"] = scan_x_range.tolist()
         config["calib_x_norm"] = x_norm.tolist()
         config["calib_x_norm_std"] = x_norm_std.tolist()
+        config["calib_x_norm_precision"] = x_precision.tolist()
+        config["calib_x_shot_norm"] = x_shot_norm.tolist()
+        config["calib_x_shot_norm_std"] = x_shot_norm_std.tolist()
         config["calib_y_range"] = scan_y_range.tolist()
         config["calib_y_norm"] = y_norm.tolist()
         config["calib_y_norm_std"] = y_norm_std.tolist()
+        config["calib_y_norm_precision"] = y_precision.tolist()
+        config["calib_y_shot_norm"] = y_shot_norm.tolist()
+        config["calib_y_shot_norm_std"] = y_shot_norm_std.tolist()
         config["calib_datetime"] = calib_datetime
+        results_pending = True
 
         doc.add_next_tick_callback(_update_plots)
         doc.add_next_tick_callback(_unlock_gui)
@@ -294,9 +434,9 @@ def create():
     calibrate_button = Button(label="Calibrate", button_type="primary")
     calibrate_button.on_click(calibrate_button_callback)
 
-    def push_results_button_callback():
-        device_name = _get_device_name()
-        if device_select.value not in ("SAROP31-PBPS113", "SAROP31-PBPS149", "SAROP21-PBPS133"):
+    def _push_results(config, device_name):
+        nonlocal results_pending
+        if device_name not in ("SAROP31-PBPS113", "SAROP31-PBPS149", "SAROP21-PBPS133"):
             epics_data = {
                 # Intensity
                 # -- input data
@@ -345,18 +485,26 @@ def create():
                 "XPOS.CALC": "J<D?G:I*(A*E-B*F)/(A*E+B*F)",
             }
 
-            for chan, data in epics_data.items():
-                epics.caput(f"{device_name}:{chan}", data, wait=True)
+            failed = epics_put_many(
+                {f"{device_name}:{chan}": data for chan, data in epics_data.items()}
+            )
+            if failed:
+                for chan, error in failed.items():
+                    log.error(f"Failed to update {chan}: {error}")
+                return
 
             log.info(f"EPICS PVs updated for {device_name}")
 
         # Push position calibration to pipeline
         pipeline_name = config["name"]
-        client.save_pipeline_config(pipeline_name, config)
-        client.stop_instance(pipeline_name)
+        pipeline_configs.save(pipeline_name, config)
+        pipeline_configs.stop_instance(pipeline_name)
+        results_pending = False
         log.info(f"camera_server config updated for {device_name}")
 
-        # Push entry to elog
+        doc.add_next_tick_callback(partial(_push_elog, config, device_name))
+
+    async def _push_elog(config, device_name):
         calib_res = [
             f"{key} = {config[key]}"
             for key in (
@@ -369,7 +517,10 @@ def create():
             )
         ]
 
-        msg_id = push_elog(
+        def _elog_done(entry_url):
+            log.info(f"Logbook entry created for {device_name} calibration: {entry_url}")
+
+        push_elog(
             figures=((fig_layout, "calibration.png"),),
             message="\n".join(calib_res),
             attributes={
@@ -377,17 +528,52 @@ def create():
                 "Entry": "Configuration",
                 "Domain": "ARAMIS",
                 "System": "Diagnostics",
-                "Title": _get_device_name(),
+                "Title": device_name,
             },
+            callback=_elog_done,
+            errback=log.error,
         )
-        log.info(
-            f"Logbook entry created for {device_name} calibration: "
-            f"https://elog-gfa.psi.ch/SF-Photonics-Data/{msg_id}"
-        )
+
+    def push_results_button_callback():
+        doc.add_next_tick_callback(_lock_gui)
+
+        # EPICS and camera_server requests run off the event loop
+        def _push():
+            try:
+                _push_results(config, _get_device_name())
+            except Exception as e:
+                log.error(e)
+            finally:
+                doc.add_next_tick_callback(_unlock_gui)
+
+        thread = Thread(target=_push)
+        thread.start()
 
     push_results_button = Button(label="Push results / elog")
     push_results_button.on_click(push_results_button_callback)
 
+    async def _reload_config(new_config):
+        nonlocal config
+        # keep results of a running or finished calibration, which are not pushed yet
+        if calibrate_button.disabled or results_pending:
+            return
+
+        if config["name"] == new_config["name"]:
+            config = new_config
+            _update_plots()
+
+    def _config_saved_callback(pipeline_name, new_config):
+        # configs can be saved from other sessions
+        if config and config["name"] == pipeline_name:
+            doc.add_next_tick_callback(partial(_reload_config, new_config))
+
+    pipeline_configs.add_listener(_config_saved_callback)
+
+    def _session_destroyed_callback(_session_context):
+        pipeline_configs.remove_listener(_config_saved_callback)
+
+    doc.on_session_destroyed(_session_destroyed_callback)
+
     # Trigger the initial device selection
     device_select.value = DEVICES[0]
 
@@ -397,6 +583,7 @@ def create():
         row(
             device_select,
             num_shots_spinner,
+            precision_spinner,
             target_select,
             column(Spacer(height=18), row(calibrate_button, push_results_button)),
         ),
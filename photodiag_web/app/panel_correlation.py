@@ -1,14 +1,55 @@
-from collections import deque
+import time
 from datetime import datetime
 from threading import Thread
 
-import bsread
 import numpy as np
 from bokeh.layouts import column, gridplot, row
-from bokeh.models import Button, ColumnDataSource, Select, Spacer, Spinner, TabPanel, Toggle
+from bokeh.models import (
+    Button,
+    CDSView,
+    ColumnDataSource,
+    GroupFilter,
+    Select,
+    Spacer,
+    Spinner,
+    TabPanel,
+    Toggle,
+)
 from bokeh.plotting import curdoc, figure
 
-from photodiag_web import DEVICES, push_elog
+from photodiag_web import DEVICES, RingBuffer, push_elog, stream_hub
+from photodiag_web.app.source_updates import BufferStreamer, DensityPlot
+from photodiag_web.density import RollingHistogram2D
+from photodiag_web.metrics import PanelStats
+from photodiag_web.stats import RollingStats, format_stats
+
+
+def normalize_values(values):
+    """Normalize values of the second device by values of the first device.
+
+    Args:
+        values (list): x, y and intensity values of the first device, followed by the ones of the
+            second device
+
+    Returns:
+        list: normalized values or None, if there are missing values or division by zero
+    """
+    if any(val is None for val in values) or 0 in values[:3]:
+        return None
+
+    return [*values[:3], values[3] / values[0], values[4] / values[1], values[5] / values[2]]
+
+
+def _scatter_columns(rows):
+    return dict(
+        parity=np.where(rows[:, 0] == 0, "even", "odd").tolist(),
+        x1=rows[:, 1],
+        y1=rows[:, 2],
+        i1=rows[:, 3],
+        x2=rows[:, 4],
+        y2=rows[:, 5],
+        i2=rows[:, 6],
+    )
 
 
 def create():
@@ -18,16 +59,26 @@ def create():
     device1_channels = ("", "", "")
     device2_name = ""
     device2_channels = ("", "", "")
+    stats = PanelStats("correlation", doc.session_context.id)
+
+    # even and odd shots are streamed to a single source, and split by views
+    scatter_source = ColumnDataSource(dict(parity=[], x1=[], y1=[], i1=[], x2=[], y2=[], i2=[]))
+    scatter_streamer = BufferStreamer(scatter_source, _scatter_columns)
+    even_view = CDSView(filter=GroupFilter(column_name="parity", group="even"))
+    odd_view = CDSView(filter=GroupFilter(column_name="parity", group="odd"))
 
     # xcorr figure
     xcorr_fig = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    xcorr_even_scatter_source = ColumnDataSource(dict(x=[], y=[]))
-    xcorr_fig.circle(source=xcorr_even_scatter_source, legend_label="even")
-
-    xcorr_odd_scatter_source = ColumnDataSource(dict(x=[], y=[]))
+    xcorr_fig.circle(x="x1", y="x2", source=scatter_source, view=even_view, legend_label="even")
     xcorr_fig.circle(
-        source=xcorr_odd_scatter_source, line_color="red", fill_color="red", legend_label="odd"
+        x="x1",
+        y="x2",
+        source=scatter_source,
+        view=odd_view,
+        line_color="red",
+        fill_color="red",
+        legend_label="odd",
     )
 
     xcorr_fig.plot.legend.click_policy = "hide"
@@ -35,12 +86,15 @@ def create():
     # ycorr figure
     ycorr_fig = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    ycorr_even_scatter_source = ColumnDataSource(dict(x=[], y=[]))
-    ycorr_fig.circle(source=ycorr_even_scatter_source, legend_label="even")
-
-    ycorr_odd_scatter_source = ColumnDataSource(dict(x=[], y=[]))
+    ycorr_fig.circle(x="y1", y="y2", source=scatter_source, view=even_view, legend_label="even")
     ycorr_fig.circle(
-        source=ycorr_odd_scatter_source, line_color="red", fill_color="red", legend_label="odd"
+        x="y1",
+        y="y2",
+        source=scatter_source,
+        view=odd_view,
+        line_color="red",
+        fill_color="red",
+        legend_label="odd",
     )
 
     ycorr_fig.plot.legend.click_policy = "hide"
@@ -48,36 +102,60 @@ def create():
     # icorr figure
     icorr_fig = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    icorr_even_scatter_source = ColumnDataSource(dict(x=[], y=[]))
-    icorr_fig.circle(source=icorr_even_scatter_source, legend_label="even")
-
-    icorr_odd_scatter_source = ColumnDataSource(dict(x=[], y=[]))
+    icorr_fig.circle(x="i1", y="i2", source=scatter_source, view=even_view, legend_label="even")
     icorr_fig.circle(
-        source=icorr_odd_scatter_source, line_color="red", fill_color="red", legend_label="odd"
+        x="i1",
+        y="i2",
+        source=scatter_source,
+        view=odd_view,
+        line_color="red",
+        fill_color="red",
+        legend_label="odd",
     )
 
     icorr_fig.plot.legend.click_policy = "hide"
 
-    buffer = deque()
+    # rolling statistics of the same column pairs are shown in figure titles
+    rolling_stats = RollingStats(pairs=((1, 4), (2, 5), (3, 6)))
+
+    # density mode for large numbers of shots
+    histogram = RollingHistogram2D(pairs=((1, 4), (2, 5), (3, 6)))
+    density_plots = [
+        DensityPlot(fig, ind) for ind, fig in enumerate((xcorr_fig, ycorr_fig, icorr_fig))
+    ]
+    density_mode = False
+
+    def _reset_plots():
+        scatter_streamer.reset()
+        rolling_stats.clear()
+        histogram.clear()
+        for density_plot in density_plots:
+            density_plot.reset()
+
+    buffer = RingBuffer(100, num_columns=7)
 
     def _collect_data():
         nonlocal buffer
-        buffer = deque(maxlen=num_shots_spinner.value)
+        buffer = RingBuffer(num_shots_spinner.value, num_columns=7)
         channels = (*device1_channels, *device2_channels)
 
         try:
-            with bsread.source(channels=channels) as stream:
+            with stream_hub.source(channels=channels) as stream:
+                stats.stream = stream
                 while update_toggle.active:
-                    msg_data = stream.receive().data
+                    message = stream.receive()
+                    if message is None:
+                        continue
+
+                    start = time.perf_counter()
+                    msg_data = message.data
                     is_odd = msg_data.pulse_id % 2
                     values = [msg_data.data.get(ch).value for ch in channels]
 
-                    # Normalize values of the second device by values of the first device
-                    if not (any(val is None for val in values) or 0 in values[:3]):
-                        values[3] /= values[0]
-                        values[4] /= values[1]
-                        values[5] /= values[2]
+                    values = normalize_values(values)
+                    if values is not None:
                         buffer.append((is_odd, *values))
+                    stats.add_shot(start, values is not None)
 
         except Exception as e:
             log.error(e)
@@ -88,33 +166,23 @@ def create():
             ycorr_fig.title.text = " "
             icorr_fig.title.text = " "
 
-            xcorr_even_scatter_source.data.update(x=[], y=[])
-            ycorr_even_scatter_source.data.update(x=[], y=[])
-            icorr_even_scatter_source.data.update(x=[], y=[])
-
-            xcorr_odd_scatter_source.data.update(x=[], y=[])
-            ycorr_odd_scatter_source.data.update(x=[], y=[])
-            icorr_odd_scatter_source.data.update(x=[], y=[])
+            _reset_plots()
             return
 
         datetime_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         title = f"{device2_name} vs {device1_name}, {datetime_now}"
-        xcorr_fig.title.text = title
-        ycorr_fig.title.text = title
-        icorr_fig.title.text = title
-
-        data_array = np.array(buffer)
-        is_even = data_array[:, 0] == 0
-        data_even = data_array[is_even, :]
-        data_odd = data_array[~is_even, :]
-
-        xcorr_even_scatter_source.data.update(x=data_even[:, 1], y=data_even[:, 4])
-        ycorr_even_scatter_source.data.update(x=data_even[:, 2], y=data_even[:, 5])
-        icorr_even_scatter_source.data.update(x=data_even[:, 3], y=data_even[:, 6])
-
-        xcorr_odd_scatter_source.data.update(x=data_odd[:, 1], y=data_odd[:, 4])
-        ycorr_odd_scatter_source.data.update(x=data_odd[:, 2], y=data_odd[:, 5])
-        icorr_odd_scatter_source.data.update(x=data_odd[:, 3], y=data_odd[:, 6])
+        rolling_stats.update(buffer)
+        for ind, fig in enumerate((xcorr_fig, ycorr_fig, icorr_fig)):
+            fig.title.text = f"{title}\n{format_stats(rolling_stats, ind)}"
+        if density_mode:
+            histogram.update(buffer)
+        stats.refresh_computed()
+
+        if density_mode:
+            for density_plot in density_plots:
+                density_plot.update(histogram)
+        else:
+            scatter_streamer.update(buffer)
 
     def device1_select_callback(_attr, _old, new):
         nonlocal device1_name, device1_channels
@@ -143,16 +211,24 @@ def create():
     device2_select.value = DEVICES[1]
 
     num_shots_spinner = Spinner(title="Number shots:", mode="int", value=100, step=100, low=100)
+    density_spinner = Spinner(
+        title="Density plot above shots:", mode="int", value=20000, step=1000, low=0
+    )
 
     update_plots_periodic_callback = None
 
     def update_toggle_callback(_attr, _old, new):
-        nonlocal update_plots_periodic_callback
+        nonlocal update_plots_periodic_callback, density_mode
         if new:
+            density_mode = num_shots_spinner.value > density_spinner.value
+            _reset_plots()
+
             thread = Thread(target=_collect_data)
             thread.start()
 
-            update_plots_periodic_callback = doc.add_periodic_callback(_update_plots, 1000)
+            update_plots_periodic_callback = doc.refresh_scheduler.add_periodic_callback(
+                _update_plots, 1000, tab_layout, stats=stats
+            )
 
             xpos1_ch, ypos1_ch, i01_ch = device1_channels
             xpos2_ch, ypos2_ch, i02_ch = device2_channels
@@ -167,16 +243,18 @@ def create():
             device1_select.disabled = True
             device2_select.disabled = True
             num_shots_spinner.disabled = True
+            density_spinner.disabled = True
             push_elog_button.disabled = True
 
             update_toggle.label = "Stop"
             update_toggle.button_type = "success"
         else:
-            doc.remove_periodic_callback(update_plots_periodic_callback)
+            doc.refresh_scheduler.remove_periodic_callback(update_plots_periodic_callback)
 
             device1_select.disabled = False
             device2_select.disabled = False
             num_shots_spinner.disabled = False
+            density_spinner.disabled = False
             push_elog_button.disabled = False
 
             update_toggle.label = "Update"
@@ -186,7 +264,13 @@ def create():
     update_toggle.on_change("active", update_toggle_callback)
 
     def push_elog_button_callback():
-        msg_id = push_elog(
+        def _elog_done(entry_url):
+            log.info(
+                f"Logbook entry created for {device2_name} vs {device1_name} correlation: "
+                f"{entry_url}"
+            )
+
+        push_elog(
             figures=((fig_layout, "correlation.png"),),
             message="",
             attributes={
@@ -196,10 +280,8 @@ def create():
                 "System": "Diagnostics",
                 "Title": f"{device2_name} vs {device1_name} correlation",
             },
-        )
-        log.info(
-            f"Logbook entry created for {device2_name} vs {device1_name} correlation: "
-            f"https://elog-gfa.psi.ch/SF-Photonics-Data/{msg_id}"
+            callback=_elog_done,
+            errback=log.error,
         )
 
     push_elog_button = Button(label="Push elog")
@@ -212,8 +294,11 @@ def create():
             device1_select,
             device2_select,
             num_shots_spinner,
+            density_spinner,
             column(Spacer(height=18), row(update_toggle, push_elog_button)),
         ),
+        stats.create_div(),
     )
+    doc.refresh_scheduler.add_periodic_callback(stats.update_div, 1000, tab_layout)
 
     return TabPanel(child=tab_layout, title="correlation")
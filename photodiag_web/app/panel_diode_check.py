@@ -1,69 +1,91 @@
-from collections import deque
+import time
 from datetime import datetime
 from threading import Thread
 
-import bsread
-import numpy as np
 from bokeh.layouts import column, gridplot, row
 from bokeh.models import ColumnDataSource, Select, Spacer, Spinner, TabPanel, Toggle
 from bokeh.plotting import curdoc, figure
-from cam_server_client import PipelineClient
 
-from photodiag_web import DEVICES
+from photodiag_web import DEVICES, RingBuffer, pipeline_configs, stream_hub
+from photodiag_web.app.source_updates import BufferStreamer
+from photodiag_web.metrics import PanelStats
 
-client = PipelineClient()
 DIODES = ["up", "down", "left", "right"]
 
 
+def normalize_by_i0(values, i0_ind):
+    """Normalize diode values by the selected diode value (= i0).
+
+    Returns:
+        tuple: i0 followed by the normalized values of other diodes or None, if there are missing
+            values or i0 is zero
+    """
+    if any(val is None for val in values) or values[i0_ind] == 0:
+        return None
+
+    i0 = values[i0_ind]
+    return (i0, *(val / i0 for ind, val in enumerate(values) if ind != i0_ind))
+
+
+def _scatter_columns(rows):
+    return dict(x=rows[:, 0], y1=rows[:, 1], y2=rows[:, 2], y3=rows[:, 3])
+
+
 def create():
     doc = curdoc()
     log = doc.logger
     device_name = ""
     diode_name = ""
+    stats = PanelStats("diode check", doc.session_context.id)
+
+    scatter_source = ColumnDataSource(dict(x=[], y1=[], y2=[], y3=[]))
+    scatter_streamer = BufferStreamer(scatter_source, _scatter_columns)
 
     # figure #1
     fig1 = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    fig1_scatter_source = ColumnDataSource(dict(x=[], y=[]))
-    fig1.circle(source=fig1_scatter_source, legend_label="data")
+    fig1.circle(x="x", y="y1", source=scatter_source, legend_label="data")
 
     fig1.plot.legend.click_policy = "hide"
 
     # figure #2
     fig2 = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    fig2_scatter_source = ColumnDataSource(dict(x=[], y=[]))
-    fig2.circle(source=fig2_scatter_source, legend_label="data")
+    fig2.circle(x="x", y="y2", source=scatter_source, legend_label="data")
 
     fig2.plot.legend.click_policy = "hide"
 
     # figure #3
     fig3 = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    fig3_scatter_source = ColumnDataSource(dict(x=[], y=[]))
-    fig3.circle(source=fig3_scatter_source, legend_label="data")
+    fig3.circle(x="x", y="y3", source=scatter_source, legend_label="data")
 
     fig3.plot.legend.click_policy = "hide"
 
-    buffer = deque()
+    buffer = RingBuffer(100, num_columns=4)
 
     def _collect_data():
         nonlocal buffer
-        buffer = deque(maxlen=num_shots_spinner.value)
-        config = client.get_pipeline_config(device_name + "_proc")
+        buffer = RingBuffer(num_shots_spinner.value, num_columns=4)
+        config = pipeline_configs.get(device_name + "_proc")
         diodes_ch = [config[diode] for diode in DIODES]
         i0_ind = DIODES.index(diode_name)
 
         try:
-            with bsread.source(channels=diodes_ch) as stream:
+            with stream_hub.source(channels=diodes_ch) as stream:
+                stats.stream = stream
                 while update_toggle.active:
-                    msg_data = stream.receive().data
+                    message = stream.receive()
+                    if message is None:
+                        continue
+
+                    start = time.perf_counter()
+                    msg_data = message.data
                     values = [msg_data.data.get(ch).value for ch in diodes_ch]
-                    # Normalize by selected diode value (= i0)
-                    if not (any(val is None for val in values) or values[i0_ind] == 0):
-                        i0 = values.pop(i0_ind)
-                        values = [val / i0 for val in values]
-                        buffer.append((i0, *values))
+                    values = normalize_by_i0(values, i0_ind)
+                    if values is not None:
+                        buffer.append(values)
+                    stats.add_shot(start, values is not None)
 
         except Exception as e:
             log.error(e)
@@ -74,10 +96,7 @@ def create():
             fig2.title.text = " "
             fig3.title.text = " "
 
-            fig1_scatter_source.data.update(x=[], y=[])
-            fig2_scatter_source.data.update(x=[], y=[])
-            fig3_scatter_source.data.update(x=[], y=[])
-
+            scatter_streamer.reset()
             return
 
         datetime_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -85,13 +104,9 @@ def create():
         fig1.title.text = title
         fig2.title.text = title
         fig3.title.text = title
+        stats.refresh_computed()
 
-        data_array = np.array(buffer)
-        x_val = data_array[:, 0]
-
-        fig1_scatter_source.data.update(x=x_val, y=data_array[:, 1])
-        fig2_scatter_source.data.update(x=x_val, y=data_array[:, 2])
-        fig3_scatter_source.data.update(x=x_val, y=data_array[:, 3])
+        scatter_streamer.update(buffer)
 
     def device_select_callback(_attr, _old, new):
         nonlocal device_name
@@ -127,7 +142,9 @@ def create():
             thread = Thread(target=_collect_data)
             thread.start()
 
-            update_plots_periodic_callback = doc.add_periodic_callback(_update_plots, 1000)
+            update_plots_periodic_callback = doc.refresh_scheduler.add_periodic_callback(
+                _update_plots, 1000, tab_layout, stats=stats
+            )
 
             diodes = DIODES.copy()
             diodes.remove(diode_name)
@@ -146,7 +163,7 @@ def create():
             update_toggle.label = "Stop"
             update_toggle.button_type = "success"
         else:
-            doc.remove_periodic_callback(update_plots_periodic_callback)
+            doc.refresh_scheduler.remove_periodic_callback(update_plots_periodic_callback)
 
             device_select.disabled = False
             diode_select.disabled = False
@@ -164,6 +181,8 @@ def create():
         row(
             device_select, diode_select, num_shots_spinner, column(Spacer(height=18), update_toggle)
         ),
+        stats.create_div(),
     )
+    doc.refresh_scheduler.add_periodic_callback(stats.update_div, 1000, tab_layout)
 
     return TabPanel(child=tab_layout, title="diode check")
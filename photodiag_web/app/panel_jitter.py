@@ -1,14 +1,36 @@
-from collections import deque
+import time
 from datetime import datetime
 from threading import Thread
 
-import bsread
 import numpy as np
 from bokeh.layouts import column, gridplot, row
-from bokeh.models import Button, ColumnDataSource, Select, Spacer, Spinner, TabPanel, Toggle
+from bokeh.models import (
+    Button,
+    CDSView,
+    ColumnDataSource,
+    GroupFilter,
+    Select,
+    Spacer,
+    Spinner,
+    TabPanel,
+    Toggle,
+)
 from bokeh.plotting import curdoc, figure
 
-from photodiag_web import DEVICES, push_elog
+from photodiag_web import DEVICES, RingBuffer, push_elog, stream_hub
+from photodiag_web.app.source_updates import BufferStreamer, DensityPlot
+from photodiag_web.density import RollingHistogram2D
+from photodiag_web.metrics import PanelStats
+from photodiag_web.stats import RollingStats, format_stats
+
+
+def _scatter_columns(rows):
+    return dict(
+        parity=np.where(rows[:, 0] == 0, "even", "odd").tolist(),
+        x=rows[:, 1],
+        y=rows[:, 2],
+        i=rows[:, 3],
+    )
 
 
 def create():
@@ -16,18 +38,23 @@ def create():
     log = doc.logger
     device_name = ""
     device_channels = ("", "", "")
+    stats = PanelStats("jitter", doc.session_context.id)
+
+    # even and odd shots are streamed to a single source, and split by views
+    scatter_source = ColumnDataSource(dict(parity=[], x=[], y=[], i=[]))
+    scatter_streamer = BufferStreamer(scatter_source, _scatter_columns)
+    even_view = CDSView(filter=GroupFilter(column_name="parity", group="even"))
+    odd_view = CDSView(filter=GroupFilter(column_name="parity", group="odd"))
 
     # xy figure
     xy_fig = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    even_scatter_source = ColumnDataSource(dict(x=[], y=[], i=[]))
-    odd_scatter_source = ColumnDataSource(dict(x=[], y=[], i=[]))
-
-    xy_fig.circle(x="x", y="y", source=even_scatter_source, legend_label="even")
+    xy_fig.circle(x="x", y="y", source=scatter_source, view=even_view, legend_label="even")
     xy_fig.circle(
         x="x",
         y="y",
-        source=odd_scatter_source,
+        source=scatter_source,
+        view=odd_view,
         line_color="red",
         fill_color="red",
         legend_label="odd",
@@ -38,11 +65,12 @@ def create():
     # ix figure
     ix_fig = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    ix_fig.circle(x="i", y="x", source=even_scatter_source, legend_label="even")
+    ix_fig.circle(x="i", y="x", source=scatter_source, view=even_view, legend_label="even")
     ix_fig.circle(
         x="i",
         y="x",
-        source=odd_scatter_source,
+        source=scatter_source,
+        view=odd_view,
         line_color="red",
         fill_color="red",
         legend_label="odd",
@@ -53,11 +81,12 @@ def create():
     # iy figure
     iy_fig = figure(title=" ", height=500, width=500, tools="pan,wheel_zoom,save,reset")
 
-    iy_fig.circle(x="i", y="y", source=even_scatter_source, legend_label="even")
+    iy_fig.circle(x="i", y="y", source=scatter_source, view=even_view, legend_label="even")
     iy_fig.circle(
         x="i",
         y="y",
-        source=odd_scatter_source,
+        source=scatter_source,
+        view=odd_view,
         line_color="red",
         fill_color="red",
         legend_label="odd",
@@ -65,20 +94,43 @@ def create():
 
     iy_fig.plot.legend.click_policy = "hide"
 
-    buffer = deque()
+    # rolling statistics of the same column pairs are shown in figure titles
+    rolling_stats = RollingStats(pairs=((1, 2), (3, 1), (3, 2)))
+
+    # density mode for large numbers of shots
+    histogram = RollingHistogram2D(pairs=((1, 2), (3, 1), (3, 2)))
+    density_plots = [DensityPlot(fig, ind) for ind, fig in enumerate((xy_fig, ix_fig, iy_fig))]
+    density_mode = False
+
+    def _reset_plots():
+        scatter_streamer.reset()
+        rolling_stats.clear()
+        histogram.clear()
+        for density_plot in density_plots:
+            density_plot.reset()
+
+    buffer = RingBuffer(100, num_columns=4)
 
     def _collect_data():
         nonlocal buffer
-        buffer = deque(maxlen=num_shots_spinner.value)
+        buffer = RingBuffer(num_shots_spinner.value, num_columns=4)
 
         try:
-            with bsread.source(channels=device_channels) as stream:
+            with stream_hub.source(channels=device_channels) as stream:
+                stats.stream = stream
                 while update_toggle.active:
-                    msg_data = stream.receive().data
+                    message = stream.receive()
+                    if message is None:
+                        continue
+
+                    start = time.perf_counter()
+                    msg_data = message.data
                     is_odd = msg_data.pulse_id % 2
                     values = [msg_data.data.get(ch).value for ch in device_channels]
-                    if not any(val is None for val in values):
+                    accepted = not any(val is None for val in values)
+                    if accepted:
                         buffer.append((is_odd, *values))
+                    stats.add_shot(start, accepted)
 
         except Exception as e:
             log.error(e)
@@ -89,23 +141,23 @@ def create():
             ix_fig.title.text = " "
             iy_fig.title.text = " "
 
-            even_scatter_source.data.update(x=[], y=[], i=[])
-            odd_scatter_source.data.update(x=[], y=[], i=[])
+            _reset_plots()
             return
 
         datetime_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         title = f"{device_name}, {datetime_now}"
-        xy_fig.title.text = title
-        ix_fig.title.text = title
-        iy_fig.title.text = title
-
-        data_array = np.array(buffer)
-        is_even = data_array[:, 0] == 0
-        data_even = data_array[is_even, :]
-        data_odd = data_array[~is_even, :]
-
-        even_scatter_source.data.update(x=data_even[:, 1], y=data_even[:, 2], i=data_even[:, 3])
-        odd_scatter_source.data.update(x=data_odd[:, 1], y=data_odd[:, 2], i=data_odd[:, 3])
+        rolling_stats.update(buffer)
+        for ind, fig in enumerate((xy_fig, ix_fig, iy_fig)):
+            fig.title.text = f"{title}\n{format_stats(rolling_stats, ind)}"
+        if density_mode:
+            histogram.update(buffer)
+        stats.refresh_computed()
+
+        if density_mode:
+            for density_plot in density_plots:
+                density_plot.update(histogram)
+        else:
+            scatter_streamer.update(buffer)
 
     def device_select_callback(_attr, _old, new):
         nonlocal device_name, device_channels
@@ -121,16 +173,24 @@ def create():
     device_select.value = DEVICES[0]
 
     num_shots_spinner = Spinner(title="Number shots:", mode="int", value=100, step=100, low=100)
+    density_spinner = Spinner(
+        title="Density plot above shots:", mode="int", value=20000, step=1000, low=0
+    )
 
     update_plots_periodic_callback = None
 
     def update_toggle_callback(_attr, _old, new):
-        nonlocal update_plots_periodic_callback
+        nonlocal update_plots_periodic_callback, density_mode
         if new:
+            density_mode = num_shots_spinner.value > density_spinner.value
+            _reset_plots()
+
             thread = Thread(target=_collect_data)
             thread.start()
 
-            update_plots_periodic_callback = doc.add_periodic_callback(_update_plots, 1000)
+            update_plots_periodic_callback = doc.refresh_scheduler.add_periodic_callback(
+                _update_plots, 1000, tab_layout, stats=stats
+            )
 
             xpos_ch, ypos_ch, i0_ch = device_channels
 
@@ -143,15 +203,17 @@ def create():
 
             device_select.disabled = True
             num_shots_spinner.disabled = True
+            density_spinner.disabled = True
             push_elog_button.disabled = True
 
             update_toggle.label = "Stop"
             update_toggle.button_type = "success"
         else:
-            doc.remove_periodic_callback(update_plots_periodic_callback)
+            doc.refresh_scheduler.remove_periodic_callback(update_plots_periodic_callback)
 
             device_select.disabled = False
             num_shots_spinner.disabled = False
+            density_spinner.disabled = False
             push_elog_button.disabled = False
 
             update_toggle.label = "Update"
@@ -161,7 +223,10 @@ def create():
     update_toggle.on_change("active", update_toggle_callback)
 
     def push_elog_button_callback():
-        msg_id = push_elog(
+        def _elog_done(entry_url):
+            log.info(f"Logbook entry created for {device_name} jitter: {entry_url}")
+
+        push_elog(
             figures=((fig_layout, "jitter.png"),),
             message="",
             attributes={
@@ -171,10 +236,8 @@ def create():
                 "System": "Diagnostics",
                 "Title": f"{device_name} jitter",
             },
-        )
-        log.info(
-            f"Logbook entry created for {device_name} jitter: "
-            f"https://elog-gfa.psi.ch/SF-Photonics-Data/{msg_id}"
+            callback=_elog_done,
+            errback=log.error,
         )
 
     push_elog_button = Button(label="Push elog")
@@ -186,8 +249,11 @@ def create():
         row(
             device_select,
             num_shots_spinner,
+            density_spinner,
             column(Spacer(height=18), row(update_toggle, push_elog_button)),
         ),
+        stats.create_div(),
     )
+    doc.refresh_scheduler.add_periodic_callback(stats.update_div, 1000, tab_layout)
 
     return TabPanel(child=tab_layout, title="jitter")
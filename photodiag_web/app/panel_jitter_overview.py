@@ -0,0 +1,228 @@
+import time
+from datetime import datetime
+from threading import Thread
+
+import numpy as np
+from bokeh.layouts import column, gridplot, row
+from bokeh.models import (
+    Button,
+    ColumnDataSource,
+    DataTable,
+    NumberFormatter,
+    Spacer,
+    Spinner,
+    TableColumn,
+    TabPanel,
+    Toggle,
+)
+from bokeh.plotting import curdoc, figure
+
+from photodiag_web import DEVICES, RingBuffer, push_elog, stream_hub
+from photodiag_web.app.source_updates import DensityPlot
+from photodiag_web.density import RollingHistogram2D
+from photodiag_web.metrics import PanelStats
+from photodiag_web.stats import RollingStats
+
+NUM_COLUMNS = 4
+
+
+def _device_channels(device):
+    return f"{device}:XPOS", f"{device}:YPOS", f"{device}:INTENSITY"
+
+
+def create():
+    doc = curdoc()
+    log = doc.logger
+    stats = PanelStats("jitter overview", doc.session_context.id)
+    channels = [ch for device in DEVICES for ch in _device_channels(device)]
+
+    # small xy density plots, one per device
+    figs = []
+    histograms = []
+    density_plots = []
+    # rms of x and y, and of intensity over (parity, x, y, i) buffer rows
+    rolling_stats = [RollingStats(pairs=((1, 2), (3, 3))) for _ in DEVICES]
+    for device in DEVICES:
+        fig = figure(title=device, height=300, width=300, tools="pan,wheel_zoom,save,reset")
+        xpos_ch, ypos_ch, _ = _device_channels(device)
+        fig.xaxis.axis_label = xpos_ch
+        fig.yaxis.axis_label = ypos_ch
+
+        histogram = RollingHistogram2D(pairs=((1, 2),), num_bins=50)
+        density_plot = DensityPlot(fig, 0)
+        fig.plot.legend.click_policy = "hide"
+
+        figs.append(fig)
+        histograms.append(histogram)
+        density_plots.append(density_plot)
+
+    # rolling rms jitter table
+    nans = [np.nan] * len(DEVICES)
+    rms_source = ColumnDataSource(
+        dict(
+            device=DEVICES,
+            shots=[0] * len(DEVICES),
+            missing=[0] * len(DEVICES),
+            x=nans,
+            y=nans,
+            i=nans,
+        )
+    )
+    rms_table = DataTable(
+        source=rms_source,
+        columns=[
+            TableColumn(field="device", title="Device"),
+            TableColumn(field="shots", title="Shots"),
+            TableColumn(field="missing", title="Missing"),
+            TableColumn(field="x", title="XPOS rms", formatter=NumberFormatter(format="0.0000")),
+            TableColumn(field="y", title="YPOS rms", formatter=NumberFormatter(format="0.0000")),
+            TableColumn(
+                field="i", title="INTENSITY rms", formatter=NumberFormatter(format="0.0000")
+            ),
+        ],
+        height=250,
+        width=650,
+        index_position=None,
+    )
+
+    def _reset_plots():
+        for histogram, density_plot, device_stats in zip(histograms, density_plots, rolling_stats):
+            histogram.clear()
+            density_plot.reset()
+            device_stats.clear()
+
+    buffers = [RingBuffer(100, num_columns=4) for _ in DEVICES]
+    # number of shots with missing values per device
+    num_missing = [0] * len(DEVICES)
+
+    def _collect_data():
+        nonlocal buffers, num_missing
+        buffers = [RingBuffer(num_shots_spinner.value, num_columns=4) for _ in DEVICES]
+        num_missing = [0] * len(DEVICES)
+
+        try:
+            # a single stream for all devices
+            with stream_hub.source(channels=channels) as stream:
+                stats.stream = stream
+                while update_toggle.active:
+                    message = stream.receive()
+                    if message is None:
+                        continue
+
+                    start = time.perf_counter()
+                    msg_data = message.data
+                    is_odd = msg_data.pulse_id % 2
+                    accepted = True
+                    for ind, (device, buffer) in enumerate(zip(DEVICES, buffers)):
+                        values = [msg_data.data.get(ch).value for ch in _device_channels(device)]
+                        if any(val is None for val in values):
+                            num_missing[ind] += 1
+                            accepted = False
+                        else:
+                            buffer.append((is_odd, *values))
+                    # a shot is rejected if any of the devices is missing values
+                    stats.add_shot(start, accepted)
+
+        except Exception as e:
+            log.error(e)
+
+    async def _update_plots():
+        datetime_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for device, fig, histogram, device_stats, buffer in zip(
+            DEVICES, figs, histograms, rolling_stats, buffers
+        ):
+            fig.title.text = f"{device}, {datetime_now}" if buffer else device
+            if buffer:
+                histogram.update(buffer)
+                device_stats.update(buffer)
+            else:
+                histogram.clear()
+                device_stats.clear()
+        stats.refresh_computed()
+
+        for histogram, density_plot in zip(histograms, density_plots):
+            density_plot.update(histogram)
+
+        xy_stats = [device_stats.get(0) for device_stats in rolling_stats]
+        i_stats = [device_stats.get(1) for device_stats in rolling_stats]
+        rms_source.data.update(
+            shots=[len(device_stats) for device_stats in rolling_stats],
+            missing=list(num_missing),
+            x=[s.std_x for s in xy_stats],
+            y=[s.std_y for s in xy_stats],
+            i=[s.std_x for s in i_stats],
+        )
+
+    num_shots_spinner = Spinner(title="Number shots:", mode="int", value=1000, step=100, low=100)
+
+    update_plots_periodic_callback = None
+
+    def update_toggle_callback(_attr, _old, new):
+        nonlocal update_plots_periodic_callback
+        if new:
+            _reset_plots()
+
+            thread = Thread(target=_collect_data)
+            thread.start()
+
+            update_plots_periodic_callback = doc.refresh_scheduler.add_periodic_callback(
+                _update_plots, 1000, tab_layout, stats=stats
+            )
+
+            num_shots_spinner.disabled = True
+            push_elog_button.disabled = True
+
+            update_toggle.label = "Stop"
+            update_toggle.button_type = "success"
+        else:
+            doc.refresh_scheduler.remove_periodic_callback(update_plots_periodic_callback)
+
+            num_shots_spinner.disabled = False
+            push_elog_button.disabled = False
+
+            update_toggle.label = "Update"
+            update_toggle.button_type = "primary"
+
+    update_toggle = Toggle(label="Update", button_type="primary")
+    update_toggle.on_change("active", update_toggle_callback)
+
+    def push_elog_button_callback():
+        def _elog_done(entry_url):
+            log.info(f"Logbook entry created for jitter overview: {entry_url}")
+
+        data = rms_source.data
+        message = "\n".join(
+            f"{device}: XPOS rms = {x:.4g}, YPOS rms = {y:.4g}, INTENSITY rms = {i:.4g}"
+            for device, x, y, i in zip(data["device"], data["x"], data["y"], data["i"])
+        )
+
+        push_elog(
+            figures=((fig_layout, "jitter_overview.png"),),
+            message=message,
+            attributes={
+                "Author": "sf-photodiag",
+                "Entry": "Info",
+                "Domain": "ARAMIS",
+                "System": "Diagnostics",
+                "Title": "Jitter overview",
+            },
+            callback=_elog_done,
+            errback=log.error,
+        )
+
+    push_elog_button = Button(label="Push elog")
+    push_elog_button.on_click(push_elog_button_callback)
+
+    fig_layout = gridplot(figs, ncols=NUM_COLUMNS, toolbar_options={"logo": None})
+    tab_layout = column(
+        fig_layout,
+        row(
+            rms_table,
+            num_shots_spinner,
+            column(Spacer(height=18), row(update_toggle, push_elog_button)),
+        ),
+        stats.create_div(),
+    )
+    doc.refresh_scheduler.add_periodic_callback(stats.update_div, 1000, tab_layout)
+
+    return TabPanel(child=tab_layout, title="jitter overview")
@@ -1,5 +1,5 @@
-import asyncio
-from collections import deque
+import time
+from copy import deepcopy
 from datetime import datetime
 from functools import partial
 from threading import Event, Thread
@@ -19,12 +19,21 @@ from bokeh.models import (
     Toggle,
 )
 from bokeh.plotting import curdoc, figure
-from lmfit.models import GaussianModel
-
-from photodiag_web import SPECT_DEV_CONFIG, epics_collect_data, get_device_domain, push_elog
-
-model = GaussianModel(prefix="g0_") + GaussianModel(prefix="g1_") + GaussianModel(prefix="g2_")
 
+from photodiag_web import (
+    SPECT_DEV_CONFIG,
+    CallbackQueue,
+    epics_collect_data,
+    fit_autocorr,
+    fit_service,
+    fwhm_monitor,
+    get_device_domain,
+    mean_autocorrelation,
+    push_elog,
+)
+from photodiag_web.autocorr import PowerSpectrumAccumulator, model
+from photodiag_web.metrics import PanelStats
+from photodiag_web.scan import MotorPositioner, PVPositioner, scan
 
 FWHM_TO_SIGMA = 1 / (2 * np.sqrt(2 * np.log(2)))  # ~= 1 / 2.355
 
@@ -33,64 +42,22 @@ def create(title):
     doc = curdoc()
     log = doc.logger
 
-    def motor_scan(pv_name, scan_range, channels, numShots, stop_event):
-        motor = epics.Motor(pv_name)
-        motor_init = motor.get_position()
-
-        scan_mean = []
-
-        for pos in scan_range:
-            val = motor.move(pos, wait=True)
-            if val != 0:
-                if val == -12:
-                    raise ValueError(f"Motor position outside soft limits: {motor.LLM} {motor.HLM}")
-                raise ValueError(f"Error moving the motor {pv_name}, error value {val}")
+    def autocorr_scan(positioner, scan_range, channels, numShots, stop_event):
+        def acquire(_pos):
+            return epics_collect_data(channels, numShots)
 
-            data = epics_collect_data(channels, numShots)
-
-            autocorr = []
-            for wf in data[0]:
-                autocorr.append(np.correlate(wf, wf, mode="same"))
-            autocorr_mean = np.mean(autocorr, axis=0)
+        def analyze(pos, data):
+            autocorr_mean = mean_autocorrelation(data[0])
             autocorr_mean_norm = autocorr_mean / np.max(autocorr_mean)
-            scan_mean.append(autocorr_mean_norm)
-
-            doc.add_next_tick_callback(partial(_update_calib_plot, pos, autocorr_mean_norm))
-
-            if stop_event.is_set():
-                break
-
-        motor.move(motor_init, wait=True)
-
-        return np.asarray(scan_mean)
-
-    def pv_scan(pv_name, scan_range, channels, numShots, stop_event):
-        pv = epics.PV(pv_name)
-        pv_init = pv.value
-        scan_mean = []
-
-        for pos in scan_range:
-            pv.put(pos, wait=True)
-
-            data = epics_collect_data(channels, numShots)
-
-            autocorr = []
-            for wf in data[0]:
-                autocorr.append(np.correlate(wf, wf, mode="same"))
-            autocorr_mean = np.mean(autocorr, axis=0)
-            autocorr_mean_norm = autocorr_mean / np.max(autocorr_mean)
-            scan_mean.append(autocorr_mean_norm)
-
-            doc.add_next_tick_callback(partial(_update_calib_plot, pos, autocorr_mean_norm))
-
-            if stop_event.is_set():
-                break
+            _submit_calib_fit(pos, autocorr_mean_norm)
 
-        pv.put(pv_init, wait=True)
+            return autocorr_mean_norm
 
-        return np.asarray(scan_mean)
+        return np.asarray(scan(positioner, scan_range, acquire, analyze, stop_event))
 
     fit_result = None
+    live_fit_key = object()
+    calib_fit_key = object()
     params = model.make_params(
         g0_sigma=dict(value=12, min=0.05),
         g0_center=dict(value=0, vary=False),
@@ -103,21 +70,13 @@ def create(title):
         g2_amplitude=dict(value=1, min=0),
     )
 
-    async def _update_fit_params():
-        device = device_select.value
-        if not device:
-            return
-
-        vals = []
-        # TODO: remove after channel names are fixed for all devices
-        tmp = epics.caget(f"{device}:FIT-FWHM")
-        chan = f"{device}:SPECTRUM_FWHM" if tmp is None else f"{device}:FIT-FWHM"
-        for _ in range(20):
-            vals.append(epics.caget(chan))
-            await asyncio.sleep(0.1)
-        params["g1_sigma"].value = np.mean(vals) * 1.4 * FWHM_TO_SIGMA
+    def _fit_params():
+        fit_params = deepcopy(params)
+        fwhm = fwhm_monitor.get(device_select.value)
+        if fwhm is not None:
+            fit_params["g1_sigma"].value = fwhm * 1.4 * FWHM_TO_SIGMA
 
-    doc.add_periodic_callback(_update_fit_params, 600_000)
+        return fit_params
 
     config = SPECT_DEV_CONFIG
     devices = list(config.keys())
@@ -199,18 +158,27 @@ def create(title):
 
     calib_fig.toolbar.logo = None
 
+    stats = PanelStats(title, doc.session_context.id)
     lags = []
-    buffer_autocorr = deque()
+    accumulator = PowerSpectrumAccumulator(100)
 
     def update_x(value, **_):
         nonlocal lags
         lags = value - value[int(value.size / 2)]
         params["g0_sigma"].value = (value[-1] - value[0]) * 0.4 * 1.4 * FWHM_TO_SIGMA
 
-        buffer_autocorr.clear()
+        accumulator.clear()
+
+    def update_y(value):
+        start = time.perf_counter()
+        accepted = value is not None
+        if accepted:
+            accumulator.add(value)
+        stats.add_shot(start, accepted)
 
-    def update_y(value, **_):
-        buffer_autocorr.append(np.correlate(value, value, mode="same"))
+    # spectra are processed in a consumer thread, not to block Channel Access callbacks
+    y_queue = CallbackQueue(update_y)
+    stats.stream = y_queue
 
     num_shots_spinner = Spinner(title="Number shots:", mode="int", value=100, low=1, width=100)
     from_spinner = Spinner(title="From:", width=100)
@@ -239,19 +207,22 @@ def create(title):
     update_plots_periodic_callback = None
 
     def update_toggle_callback(_attr, _old, new):
-        nonlocal update_plots_periodic_callback, lags, buffer_autocorr
+        nonlocal update_plots_periodic_callback, lags, accumulator
         pv_x = pvs_x[device_select.value]
         pv_y = pvs_y[device_select.value]
         if new:
             value = pv_x.value
             lags = value - value[int(value.size / 2)]
             params["g0_sigma"].value = (value[-1] - value[0]) * 0.4 * 1.4 * FWHM_TO_SIGMA
-            buffer_autocorr = deque(maxlen=num_shots_spinner.value)
+            accumulator = PowerSpectrumAccumulator(num_shots_spinner.value)
 
             pv_x.add_callback(update_x)
-            pv_y.add_callback(update_y)
+            y_queue.start()
+            pv_y.add_callback(y_queue.put)
 
-            update_plots_periodic_callback = doc.add_periodic_callback(_update_plots, 3000)
+            update_plots_periodic_callback = doc.refresh_scheduler.add_periodic_callback(
+                _update_plots, 3000, tab_layout, stats=stats
+            )
             doc.add_next_tick_callback(_live_lock_gui)
 
             update_toggle.label = "Stop"
@@ -259,8 +230,9 @@ def create(title):
         else:
             pv_x.clear_callbacks()
             pv_y.clear_callbacks()
+            y_queue.stop()
 
-            doc.remove_periodic_callback(update_plots_periodic_callback)
+            doc.refresh_scheduler.remove_periodic_callback(update_plots_periodic_callback)
             doc.add_next_tick_callback(_live_unlock_gui)
 
             update_toggle.label = "Update"
@@ -310,16 +282,25 @@ def create(title):
             num_shots_spinner.disabled = False
         push_fit_elog_button.disabled = False
 
-    async def _update_calib_plot(x, wf):
+    def _submit_calib_fit(x, wf):
         pv_x = pvs_x[device_select.value]
         value = pv_x.value
         lags = value - value[int(value.size / 2)]
 
-        fit_result = model.fit(wf, params, x=lags)
-        spike_fwhm = min(
-            fit_result.values["g0_fwhm"], fit_result.values["g1_fwhm"], fit_result.values["g2_fwhm"]
+        fit_service.submit(
+            doc,
+            fit_autocorr,
+            (wf, lags, _fit_params()),
+            partial(_update_calib_plot, x),
+            key=calib_fit_key,
+            drop_stale=False,
+            errback=log.error,
         )
 
+    async def _update_calib_plot(x, calib_fit):
+        values = calib_fit["values"]
+        spike_fwhm = min(values["g0_fwhm"], values["g1_fwhm"], values["g2_fwhm"])
+
         calib_line_source.stream(dict(x=[x], y=[spike_fwhm / 1.4]))
 
     async def _reset_calib_plot():
@@ -335,15 +316,14 @@ def create(title):
 
         doc.add_next_tick_callback(_reset_calib_plot)
 
-        # TODO: find a simpler way to scan PVs and Motors
-        if device_name == "SARFE10-PSSS059":
-            scan_func = motor_scan
-        else:
-            scan_func = pv_scan
-
         try:
-            wf_mean = scan_func(pv_name, scan_range, channels, numShots, calib_stop_event)
-        except ValueError as e:
+            if device_name == "SARFE10-PSSS059":
+                positioner = MotorPositioner(pv_name)
+            else:
+                positioner = PVPositioner(pv_name)
+
+            wf_mean = autocorr_scan(positioner, scan_range, channels, numShots, calib_stop_event)
+        except (ValueError, TimeoutError) as e:
             log.error(e)
         else:
             log.info(f"{device_name} calibrated")
@@ -373,30 +353,45 @@ def create(title):
     calibrate_button.on_change("active", calibrate_button_callback)
 
     async def _update_plots():
-        nonlocal fit_result
-        if len(buffer_autocorr) < 4:
+        if len(accumulator) < 4:
             autocorr_lines_source.data.update(
                 x=[], y_autocorr=[], y_fit=[], y_bkg=[], y_env=[], y_spike=[]
             )
             fwhm_lines_source.data.update(x=[], fwhm_bkg=[], fwhm_env=[], fwhm_spike=[])
             return
 
-        autocorr = np.array(buffer_autocorr)
-        y_autocorr = autocorr.mean(axis=0)
+        y_autocorr = accumulator.mean_autocorrelation()
         y_autocorr /= np.max(y_autocorr)
+        stats.refresh_computed()
+
+        # Only the most recent autocorrelation is fitted, if the workers can't keep up
+        fit_service.submit(
+            doc,
+            fit_autocorr,
+            (y_autocorr, lags, _fit_params()),
+            partial(_update_fit_plots, lags, y_autocorr, time.perf_counter()),
+            key=live_fit_key,
+            errback=log.error,
+        )
+
+    async def _update_fit_plots(lags, y_autocorr, submitted, live_fit):
+        nonlocal fit_result
+        stats.add_fit(submitted)
+        if not update_toggle.active:
+            return
 
-        fit_result = model.fit(y_autocorr, params, x=lags)
-        y_fit = fit_result.best_fit
+        fit_result = live_fit
+        y_fit = fit_result["best_fit"]
 
         # Sort the fwhm values (sometimes they are swapped despite initial guesses)
         fwhm = [
-            fit_result.values["g0_fwhm"],
-            fit_result.values["g1_fwhm"],
-            fit_result.values["g2_fwhm"],
+            fit_result["values"]["g0_fwhm"],
+            fit_result["values"]["g1_fwhm"],
+            fit_result["values"]["g2_fwhm"],
         ]
         spike_ind, env_idx, bkg_idx = np.argsort(fwhm)
 
-        components = fit_result.eval_components(x=lags)
+        components = fit_result["components"]
 
         y_bkg = components[f"g{bkg_idx}_"]
         y_env = components[f"g{env_idx}_"]
@@ -425,7 +420,7 @@ def create(title):
         nonlocal lags
         # reset figures
         lags = []
-        buffer_autocorr.clear()
+        accumulator.clear()
         doc.add_next_tick_callback(_update_plots)
         doc.add_next_tick_callback(_reset_calib_plot)
 
@@ -435,6 +430,7 @@ def create(title):
         to_spinner.value = dev_conf["to"]
         step_spinner.value = dev_conf["step"]
         motor_textinput.value = dev_conf["motor"]
+        fwhm_monitor.monitor(new)
 
         # connect pos_spinner widget to the PV
         for pv in pvs_m.values():
@@ -451,9 +447,12 @@ def create(title):
         device_name = device_select.value
         domain = get_device_domain(device_name)
 
-        msg_id = push_elog(
+        def _elog_done(entry_url):
+            log.info(f"Logbook entry created for {device_name}: {entry_url}")
+
+        push_elog(
             figures=((autocorr_layout, "fit.png"),),
-            message=fit_result.fit_report(),
+            message=fit_result["report"],
             attributes={
                 "Author": "sf-photodiag",
                 "Entry": "Info",
@@ -461,10 +460,8 @@ def create(title):
                 "System": "Diagnostics",
                 "Title": f"{device_name} Autocorrelation fit results",
             },
-        )
-        log.info(
-            f"Logbook entry created for {device_name}: "
-            f"https://elog-gfa.psi.ch/SF-Photonics-Data/{msg_id}"
+            callback=_elog_done,
+            errback=log.error,
         )
 
     push_fit_elog_button = Button(label="Push fit elog")
@@ -474,7 +471,10 @@ def create(title):
         device_name = device_select.value
         domain = get_device_domain(device_name)
 
-        msg_id = push_elog(
+        def _elog_done(entry_url):
+            log.info(f"Logbook entry created for {device_name} callibration: {entry_url}")
+
+        push_elog(
             figures=((calib_layout, "calibration.png"),),
             message="",
             attributes={
@@ -484,10 +484,8 @@ def create(title):
                 "System": "Diagnostics",
                 "Title": f"{device_name} resolution",
             },
-        )
-        log.info(
-            f"Logbook entry created for {device_name} callibration: "
-            f"https://elog-gfa.psi.ch/SF-Photonics-Data/{msg_id}"
+            callback=_elog_done,
+            errback=log.error,
         )
 
     push_calib_elog_button = Button(label="Push calib elog")
@@ -517,6 +515,8 @@ def create(title):
             column(Spacer(height=18), calibrate_button),
             column(Spacer(height=18), push_calib_elog_button),
         ),
+        stats.create_div(),
     )
+    doc.refresh_scheduler.add_periodic_callback(stats.update_div, 1000, tab_layout)
 
     return TabPanel(child=tab_layout, title=title)
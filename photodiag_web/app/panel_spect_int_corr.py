@@ -1,12 +1,17 @@
-from collections import deque
+import time
 from threading import Lock, Thread
 
-import bsread
 import numpy as np
 from bokeh.layouts import column, row
 from bokeh.models import ColumnDataSource, Spacer, Spinner, TabPanel, Toggle
 from bokeh.plotting import curdoc, figure
 
+from photodiag_web import RingBuffer, WaveformRingBuffer, stream_hub
+from photodiag_web.app.source_updates import ImagePatcher
+from photodiag_web.metrics import PanelStats
+
+NUM_I0_BINS = 20
+
 
 def pearson_1D(spectra, I0):
     diff1 = spectra - np.mean(spectra, axis=0)
@@ -15,17 +20,178 @@ def pearson_1D(spectra, I0):
     return res
 
 
+def _bin_sums(bin_ind, spectra, num_bins):
+    # one-hot matrix product instead of a python loop over boolean masks
+    one_hot = bin_ind[np.newaxis, :] == np.arange(num_bins)[:, np.newaxis]
+    return one_hot.sum(axis=1), one_hot.astype(spectra.dtype) @ spectra
+
+
 def spectra_bin_I0(I0, I0_bins, spectra):
-    spectra_len = spectra.shape[1]
-    spec_zero = np.zeros(spectra_len)
-    spec_binned = np.empty((len(I0_bins), spectra_len))
+    bin_ind = np.digitize(I0, I0_bins) - 1
+    counts, sums = _bin_sums(bin_ind, spectra, len(I0_bins))
+
+    return sums / np.maximum(counts, 1)[:, np.newaxis]
+
+
+class SpectraI0Accumulator:
+    """Sliding window accumulator of spectra vs I0 statistics.
+
+    Keeps running sums and co-moments of the last `maxlen` shots, adding new shots and
+    subtracting evicted ones, so that the correlation coefficients and I0-binned spectra are
+    available in O(n_pixels) time per update. Binned sums are rebuilt only when the I0 range of
+    the window changes, and all sums are periodically rebuilt to avoid accumulating rounding
+    errors.
+
+    Args:
+        maxlen (int): number of shots in the sliding window
+        num_bins (int, optional): number of I0 bins, defaults to NUM_I0_BINS
+    """
+
+    def __init__(self, maxlen, num_bins=NUM_I0_BINS):
+        self.maxlen = maxlen
+        self.num_bins = num_bins
+
+        self._spectra = WaveformRingBuffer(maxlen, dtype=np.float64)
+        self._i0 = RingBuffer(maxlen)
+        self._lock = Lock()
+
+        self._moments = None
+        self._bins = None
+        self._num_updates = 0
+
+    def __len__(self):
+        return len(self._i0)
+
+    def clear(self):
+        with self._lock:
+            self._spectra.clear()
+            self._i0.clear()
+            self._moments = None
+            self._bins = None
+
+    def add(self, spectrum, i0):
+        spectrum = np.asarray(spectrum, dtype=np.float64)
+        with self._lock:
+            if self._moments is not None and self._moments["sx"].shape != spectrum.shape:
+                # spectrum length changed, restart accumulation
+                self._i0.clear()
+                self._moments = None
+                self._bins = None
+
+            if len(self._i0) == self.maxlen:
+                self._evict_oldest()
+
+            self._spectra.append(spectrum)
+            self._i0.append(i0)
+
+            if self._moments is None:
+                self._rebuild_moments()
+            else:
+                self._add_moments(spectrum, i0, 1)
+                self._num_updates += 1
+
+            if self._bins is not None:
+                edges, counts, sums = self._bins
+                if edges[0] <= i0 <= edges[-1]:
+                    bin_ind = np.digitize(i0, edges) - 1
+                    counts[bin_ind] += 1
+                    sums[bin_ind] += spectrum
+                else:
+                    # I0 range of the window has changed
+                    self._bins = None
+
+    def _evict_oldest(self):
+        oldest = self._i0.count - self.maxlen
+        spectrum = self._spectra.view(oldest, oldest + 1)[0]
+        i0 = self._i0.view(oldest, oldest + 1)[0]
+
+        self._add_moments(spectrum, i0, -1)
+        self._num_updates += 1
+
+        if self._bins is not None:
+            edges, counts, sums = self._bins
+            if i0 in (edges[0], edges[-1]):
+                # an extreme value leaves the window, so the I0 range might change
+                self._bins = None
+            else:
+                # bins are the same as when all shots in the window were accounted
+                bin_ind = np.digitize(i0, edges) - 1
+                counts[bin_ind] -= 1
+                sums[bin_ind] -= spectrum
+
+    def _add_moments(self, spectrum, i0, sign):
+        m = self._moments
+        x = spectrum - m["shift_x"]
+        y = i0 - m["shift_y"]
+        m["n"] += sign
+        m["sx"] += sign * x
+        m["sxx"] += sign * x**2
+        m["sy"] += sign * y
+        m["syy"] += sign * y**2
+        m["sxy"] += sign * x * y
+
+    def _rebuild_moments(self):
+        spectra = self._spectra.view()
+        i0 = self._i0.view()
+
+        # shifting by the window mean keeps the running sums small, which reduces cancellation
+        shift_x = spectra.mean(axis=0)
+        shift_y = i0.mean()
+        x = spectra - shift_x
+        y = i0 - shift_y
+
+        self._moments = dict(
+            shift_x=shift_x,
+            shift_y=shift_y,
+            n=len(i0),
+            sx=x.sum(axis=0),
+            sxx=(x**2).sum(axis=0),
+            sy=y.sum(),
+            syy=(y**2).sum(),
+            sxy=y @ x,
+        )
+        self._num_updates = 0
+
+    def _rebuild_bins(self):
+        spectra = self._spectra.view()
+        i0 = self._i0.view()
+
+        edges = np.linspace(i0.min(), i0.max(), self.num_bins)
+        bin_ind = np.digitize(i0, edges) - 1
+        counts, sums = _bin_sums(bin_ind, spectra, self.num_bins)
+
+        self._bins = (edges, counts, sums)
+
+    def get(self):
+        """Return the current statistics of the window.
 
-    digi = np.digitize(I0, I0_bins)
-    for i in range(0, len(I0_bins)):
-        ind = digi == i + 1
-        spec_binned[i, :] = spectra[ind, :].mean(axis=0) if any(ind) else spec_zero
+        Returns:
+            tuple: correlation coefficients of spectra with I0 for each pixel, I0-binned mean
+                spectra of shape (num_bins, n_pixels), I0 min and max values; or None if the
+                window has less than 3 shots
+        """
+        with self._lock:
+            if len(self._i0) < 3:
+                return None
 
-    return spec_binned
+            if self._num_updates >= self.maxlen:
+                self._rebuild_moments()
+                self._rebuild_bins()
+
+            if self._bins is None:
+                self._rebuild_bins()
+
+            m = self._moments
+            n = m["n"]
+            cov = m["sxy"] - m["sx"] * m["sy"] / n
+            var_x = m["sxx"] - m["sx"] ** 2 / n
+            var_y = m["syy"] - m["sy"] ** 2 / n
+            pearson_coeff = cov / np.sqrt(var_x * var_y)
+
+            edges, counts, sums = self._bins
+            spectra_binned = sums / np.maximum(counts, 1)[:, np.newaxis]
+
+            return pearson_coeff, spectra_binned, edges[0], edges[-1]
 
 
 def create():
@@ -37,8 +203,6 @@ def create():
         "SARFE10-PBPS053:INTENSITY",
     )
 
-    lock = Lock()
-
     # correlation coefficient figure
     corr_coef_fig = figure(
         height=250,
@@ -81,27 +245,33 @@ def create():
 
     single_int_image_source = ColumnDataSource(dict(image=[], x=[], y=[], dw=[], dh=[]))
     single_int_fig.image(source=single_int_image_source, palette="Magma256")
+    single_int_image_patcher = ImagePatcher(single_int_image_source)
 
+    stats = PanelStats("Aramis Spectral intensity correlation", doc.session_context.id)
     cache_spec_x = []
-    buffer_spec_y = deque()
-    buffer_i0 = deque()
+    accumulator = SpectraI0Accumulator(100)
 
     def _collect_data():
-        nonlocal cache_spec_x, buffer_spec_y, buffer_i0
+        nonlocal cache_spec_x, accumulator
         cache_spec_x = []
-        buffer_spec_y = deque(maxlen=num_shots_spinner.value)
-        buffer_i0 = deque(maxlen=num_shots_spinner.value)
+        accumulator = SpectraI0Accumulator(num_shots_spinner.value)
 
         try:
-            with bsread.source(channels=device_channels) as stream:
+            with stream_hub.source(channels=device_channels) as stream:
+                stats.stream = stream
                 while update_toggle.active:
-                    msg_data = stream.receive().data
+                    message = stream.receive()
+                    if message is None:
+                        continue
+
+                    start = time.perf_counter()
+                    msg_data = message.data
                     values = [msg_data.data.get(ch).value for ch in device_channels]
-                    if not any(val is None for val in values):
+                    accepted = not any(val is None for val in values)
+                    if accepted:
                         cache_spec_x, spec_y, i0 = values
-                        with lock:
-                            buffer_spec_y.append(spec_y)
-                            buffer_i0.append(i0)
+                        accumulator.add(spec_y, i0)
+                    stats.add_shot(start, accepted)
 
         except Exception as e:
             log.error(e)
@@ -116,14 +286,16 @@ def create():
             thread = Thread(target=_collect_data)
             thread.start()
 
-            update_plots_periodic_callback = doc.add_periodic_callback(_update_plots, 1000)
+            update_plots_periodic_callback = doc.refresh_scheduler.add_periodic_callback(
+                _update_plots, 1000, tab_layout, stats=stats
+            )
 
             num_shots_spinner.disabled = True
 
             update_toggle.label = "Stop"
             update_toggle.button_type = "success"
         else:
-            doc.remove_periodic_callback(update_plots_periodic_callback)
+            doc.refresh_scheduler.remove_periodic_callback(update_plots_periodic_callback)
 
             num_shots_spinner.disabled = False
 
@@ -134,48 +306,44 @@ def create():
     update_toggle.on_change("active", update_toggle_callback)
 
     async def _update_plots():
-        if len(buffer_spec_y) < 3:
+        accumulated = accumulator.get()
+        if accumulated is None:
             corr_coef_line_source.data.update(x=[], y=[])
             spec_int_line1_source.data.update(x=[], y=[])
             spec_int_line2_source.data.update(x=[], y=[])
             spec_int_line3_source.data.update(x=[], y=[])
-            single_int_image_source.data.update(image=[], x=[], y=[], dw=[], dh=[])
+            single_int_image_patcher.reset()
             return
 
-        spec_x = cache_spec_x
-        with lock:
-            buffer_spec_y_cp = buffer_spec_y.copy()
-            buffer_i0_cp = buffer_i0.copy()
-        spec_y = np.array(buffer_spec_y_cp)
-        i0 = np.array(buffer_i0_cp)
-
-        min_int_bin = np.min(i0)
-        max_int_bin = np.max(i0)
-        bins = np.linspace(min_int_bin, max_int_bin, 20)
-        mid_bin_ind = int(len(bins) / 2)
-
-        pearson_coeff = pearson_1D(spec_y, i0)
-        spectra_binned = spectra_bin_I0(i0, bins, spec_y)
+        spec_x = np.asarray(cache_spec_x, dtype=np.float32)
+        pearson_coeff, spectra_binned, min_int_bin, max_int_bin = accumulated
+        pearson_coeff = pearson_coeff.astype(np.float32)
+        mid_bin_ind = int(len(spectra_binned) / 2)
+        spec_int = (spectra_binned / np.max(spectra_binned)).astype(np.float32)
+        stats.refresh_computed()
 
         # update glyph sources
         corr_coef_line_source.data.update(x=spec_x, y=pearson_coeff)
 
-        max_spectra = np.max(spectra_binned)
-        spec_int_line1_source.data.update(x=spec_x, y=spectra_binned[-1, :] / max_spectra)
-        spec_int_line2_source.data.update(x=spec_x, y=spectra_binned[mid_bin_ind, :] / max_spectra)
-        spec_int_line3_source.data.update(x=spec_x, y=spectra_binned[0, :] / max_spectra)
-
-        single_int_image_source.data.update(
-            image=[spectra_binned],
-            x=[spec_x[0]],
-            dw=[spec_x[-1] - spec_x[0]],
-            y=[min_int_bin],
-            dh=[max_int_bin - min_int_bin],
+        spec_int_line1_source.data.update(x=spec_x, y=spec_int[-1, :])
+        spec_int_line2_source.data.update(x=spec_x, y=spec_int[mid_bin_ind, :])
+        spec_int_line3_source.data.update(x=spec_x, y=spec_int[0, :])
+
+        # only image rows of I0 bins that got new or dropped shots are sent
+        single_int_image_patcher.update(
+            spectra_binned,
+            x=float(spec_x[0]),
+            y=float(min_int_bin),
+            dw=float(spec_x[-1] - spec_x[0]),
+            dh=float(max_int_bin - min_int_bin),
         )
 
     fig_layout = row(column(corr_coef_fig, spec_int_fig), single_int_fig)
     tab_layout = column(
-        fig_layout, row(num_shots_spinner, column(Spacer(height=18), update_toggle))
+        fig_layout,
+        row(num_shots_spinner, column(Spacer(height=18), update_toggle)),
+        stats.create_div(),
     )
+    doc.refresh_scheduler.add_periodic_callback(stats.update_div, 1000, tab_layout)
 
     return TabPanel(child=tab_layout, title="Aramis Spectral intensity correlation")
@@ -1,13 +1,76 @@
-from collections import deque
+import time
 from threading import Thread
 
-import bsread
 import numpy as np
 from bokeh.layouts import column, row
 from bokeh.models import ColumnDataSource, Select, Spacer, Spinner, TabPanel, Toggle
 from bokeh.plotting import curdoc, figure
 from scipy.signal import find_peaks
 
+from photodiag_web import RingBuffer, stream_hub
+from photodiag_web.metrics import PanelStats
+
+# spectra are processed in batches of up to PEAKS_BATCH_SIZE shots or PEAKS_BATCH_TIME seconds
+PEAKS_BATCH_SIZE = 10
+PEAKS_BATCH_TIME = 0.2
+
+
+def box_filter(y, kernel_size):
+    """Moving average along the last axis, equal to `np.convolve(y, kernel, mode="same")` with a
+    box kernel, for kernels not longer than the signal.
+
+    It is computed from cumulative sums in O(N) time, independent of the kernel size.
+    """
+    n = y.shape[-1]
+    left = kernel_size // 2
+    csum = np.empty((*y.shape[:-1], n + kernel_size))
+    csum[..., : left + 1] = 0
+    np.cumsum(y, axis=-1, out=csum[..., left + 1 : left + 1 + n])
+    csum[..., left + 1 + n :] = csum[..., left + n : left + n + 1]
+
+    return (csum[..., kernel_size : kernel_size + n] - csum[..., :n]) / kernel_size
+
+
+def _gradient(spectra, kernel_size):
+    spectra = spectra / np.max(spectra, axis=-1, keepdims=True)
+    spectra_convolved = box_filter(spectra, kernel_size)
+    spectra_grad = np.abs(np.gradient(spectra_convolved, axis=-1))
+    return spectra, spectra_convolved, spectra_grad
+
+
+def process_spectrum(spec_y, kernel_size, peak_dist, peak_height):
+    """Normalize and smooth a spectrum, and find peaks in the absolute value of its gradient.
+
+    Returns:
+        tuple: normalized spectrum, smoothed spectrum, abs of gradient and peak indices
+    """
+    spec_y, spec_y_convolved, spec_y_grad = _gradient(spec_y, kernel_size)
+    peaks, _ = find_peaks(spec_y_grad, distance=peak_dist, height=peak_height)
+
+    return spec_y, spec_y_convolved, spec_y_grad, peaks
+
+
+def count_peaks(spectra, kernel_size, peak_dist, peak_height):
+    """Count peaks in the absolute value of gradients of a batch of spectra.
+
+    The result is the same as the number of peaks found by `process_spectrum` for every spectrum.
+    Normalization, smoothing and gradients are computed for all spectra at once, and only the
+    peak search (`find_peaks`, which is cheap in comparison) runs per spectrum.
+
+    Args:
+        spectra (ndarray): 2D array of spectra, one per row
+        kernel_size (int): size of the smoothing kernel
+        peak_dist (int): minimal distance between peaks
+        peak_height (float): minimal height of peaks
+
+    Returns:
+        ndarray: number of peaks in each spectrum
+    """
+    _, _, grad = _gradient(spectra, kernel_size)
+    return np.array(
+        [len(find_peaks(row, distance=peak_dist, height=peak_height)[0]) for row in grad]
+    )
+
 
 def create(title, devices):
     doc = curdoc()
@@ -15,6 +78,7 @@ def create(title, devices):
 
     device_name = ""
     device_channels = ("", "")
+    stats = PanelStats(title, doc.session_context.id)
 
     # single shot spectrum figure
     single_shot_fig = figure(
@@ -55,33 +119,57 @@ def create(title, devices):
     num_peaks_dist_quad_source = ColumnDataSource(dict(left=[], right=[], top=[]))
     num_peaks_dist_fig.quad(source=num_peaks_dist_quad_source, bottom=0)
 
-    single_shot_cache = [[], [], [], [], 0]
-    buffer_num_peaks = deque()
+    # the last spectrum is processed for display only on plot updates
+    single_shot_cache = None
+    buffer_num_peaks = RingBuffer(100)
 
     def _collect_data():
         nonlocal single_shot_cache, buffer_num_peaks
-        single_shot_cache = [[], [], [], [], 0]
-        buffer_num_peaks = deque(maxlen=num_shots_spinner.value)
+        single_shot_cache = None
+        buffer_num_peaks = RingBuffer(num_shots_spinner.value)
 
         kernel_size = kernel_size_spinner.value
-        kernel = np.ones(kernel_size) / kernel_size
         peak_dist = peak_dist_spinner.value
         peak_height = peak_height_spinner.value
 
+        batch = []
+        batch_start = 0
+
+        def _process_batch():
+            start = time.perf_counter()
+            num_peaks = count_peaks(np.array(batch), kernel_size, peak_dist, peak_height)
+            for val in num_peaks:
+                buffer_num_peaks.append(val / 2)
+            stats.add_shots(start, len(batch))
+            batch.clear()
+
         try:
-            with bsread.source(channels=device_channels) as stream:
+            with stream_hub.source(channels=device_channels) as stream:
+                stats.stream = stream
                 while update_toggle.active:
-                    msg_data = stream.receive().data
+                    message = stream.receive()
+                    if message is None:
+                        if batch:
+                            _process_batch()
+                        continue
+
+                    start = time.perf_counter()
+                    msg_data = message.data
                     values = [msg_data.data.get(ch).value for ch in device_channels]
-                    if not any(val is None for val in values):
-                        spec_x, spec_y = values
-                        spec_y = spec_y / np.max(spec_y)
-                        spec_y_convolved = np.convolve(spec_y, kernel, mode="same")
-                        spec_y_grad = np.abs(np.gradient(spec_y_convolved))
-                        peaks, _ = find_peaks(spec_y_grad, distance=peak_dist, height=peak_height)
+                    if any(val is None for val in values):
+                        stats.add_shot(start, accepted=False)
+                        continue
+
+                    spec_x, spec_y = values
+                    if batch and len(spec_y) != len(batch[0]):
+                        _process_batch()
 
-                        single_shot_cache = [spec_x, spec_y, spec_y_convolved, spec_y_grad, peaks]
-                        buffer_num_peaks.append(len(peaks) / 2)
+                    if not batch:
+                        batch_start = start
+                    batch.append(spec_y)
+                    single_shot_cache = (spec_x, spec_y)
+                    if len(batch) >= PEAKS_BATCH_SIZE or start - batch_start > PEAKS_BATCH_TIME:
+                        _process_batch()
 
         except Exception as e:
             log.error(e)
@@ -99,7 +187,9 @@ def create(title, devices):
             thread = Thread(target=_collect_data)
             thread.start()
 
-            update_plots_periodic_callback = doc.add_periodic_callback(_update_plots, 1000)
+            update_plots_periodic_callback = doc.refresh_scheduler.add_periodic_callback(
+                _update_plots, 1000, tab_layout, stats=stats
+            )
 
             device_select.disabled = True
             num_shots_spinner.disabled = True
@@ -110,7 +200,7 @@ def create(title, devices):
             update_toggle.label = "Stop"
             update_toggle.button_type = "success"
         else:
-            doc.remove_periodic_callback(update_plots_periodic_callback)
+            doc.refresh_scheduler.remove_periodic_callback(update_plots_periodic_callback)
 
             device_select.disabled = False
             num_shots_spinner.disabled = False
@@ -129,12 +219,16 @@ def create(title, devices):
             num_peaks_dist_quad_source.data.update(left=[], right=[], top=[])
             return
 
-        spec_x, spec_y, spec_y_convolved, spec_y_grad, peaks = single_shot_cache
+        spec_x, spec_y = single_shot_cache
+        spec_y, spec_y_convolved, spec_y_grad, peaks = process_spectrum(
+            spec_y, kernel_size_spinner.value, peak_dist_spinner.value, peak_height_spinner.value
+        )
 
-        num_peaks = np.array(buffer_num_peaks)
+        num_peaks = buffer_num_peaks.view()
         # this way it includes the max number of peaks in the range
         bins = np.arange(num_peaks.min() - 0.25, num_peaks.max() + 0.5, 0.5)
         counts, edges = np.histogram(num_peaks, bins=bins)
+        stats.refresh_computed()
 
         # update glyph sources
         single_shot_line_source.data.update(x=spec_x, y=spec_y)
@@ -149,7 +243,7 @@ def create(title, devices):
         device_channels = f"{device_name}:SPECTRUM_X", f"{device_name}:SPECTRUM_Y"
 
         # reset figures
-        single_shot_cache = [[], [], [], [], 0]
+        single_shot_cache = None
         buffer_num_peaks.clear()
         doc.add_next_tick_callback(_update_plots)
 
@@ -168,6 +262,8 @@ def create(title, devices):
             peak_height_spinner,
             column(Spacer(height=18), update_toggle),
         ),
+        stats.create_div(),
     )
+    doc.refresh_scheduler.add_periodic_callback(stats.update_div, 1000, tab_layout)
 
     return TabPanel(child=tab_layout, title=title)
@@ -0,0 +1,99 @@
+from bokeh.events import DocumentReady
+from bokeh.models import CustomJS, Tabs, Toggle
+
+_PAGE_VISIBILITY_JS = """
+document.addEventListener("visibilitychange", () => {
+    toggle.active = document.visibilityState === "visible"
+})
+"""
+
+
+class RefreshScheduler:
+    """Run periodic plot updates of panels only while they are visible.
+
+    A panel is visible if its layout is reachable from the document roots through the active tabs
+    of all Tabs on the way, and the browser page itself is not hidden or minimized. Acquisition
+    is not affected, only the plot update callbacks are skipped.
+
+    The `page_visible_toggle` widget needs to be added to the document layout.
+    """
+
+    def __init__(self, doc):
+        self._doc = doc
+        self._visible = set()
+        self._callbacks = {}
+
+        self.page_visible_toggle = Toggle(active=True, visible=False)
+        self.page_visible_toggle.on_change("active", self._page_visible_callback)
+        doc.js_on_event(
+            DocumentReady,
+            CustomJS(args=dict(toggle=self.page_visible_toggle), code=_PAGE_VISIBILITY_JS),
+        )
+
+    def is_visible(self, layout):
+        return self.page_visible_toggle.active and layout.id in self._visible
+
+    def add_periodic_callback(self, callback, period_milliseconds, layout, stats=None):
+        """Add an async periodic callback that only runs while the layout is visible.
+
+        Args:
+            callback (callable): async callback
+            period_milliseconds (int): callback period
+            layout (LayoutDOM): layout that needs to be visible for the callback to run
+            stats (PanelStats, optional): record refresh times of the callback
+
+        Returns:
+            PeriodicCallback: a handle to be passed to `remove_periodic_callback`
+        """
+
+        async def _visible_callback():
+            if self.is_visible(layout):
+                if stats is not None:
+                    stats.refresh_started()
+                await callback()
+                if stats is not None:
+                    stats.refresh_finished()
+
+        handle = self._doc.add_periodic_callback(_visible_callback, period_milliseconds)
+        self._callbacks[handle] = (callback, layout)
+
+        return handle
+
+    def remove_periodic_callback(self, handle):
+        self._callbacks.pop(handle, None)
+        self._doc.remove_periodic_callback(handle)
+
+    def update_visibility(self):
+        """Recalculate visible layouts, should be called on any change of active tabs."""
+        visible = set()
+        for root in self._doc.roots:
+            _collect_visible(root, visible)
+
+        newly_visible = visible - self._visible
+        self._visible = visible
+        self._refresh(newly_visible)
+
+    def _page_visible_callback(self, _attr, _old, new):
+        if new:
+            self._refresh(self._visible)
+
+    def _refresh(self, layout_ids):
+        # don't wait for the next period to show up-to-date plots
+        for callback, layout in self._callbacks.values():
+            if layout.id in layout_ids:
+                self._doc.add_next_tick_callback(callback)
+
+
+def _collect_visible(model, visible):
+    visible.add(model.id)
+
+    if isinstance(model, Tabs):
+        children = [model.tabs[model.active].child] if model.tabs else []
+    else:
+        children = getattr(model, "children", [])
+
+    for child in children:
+        # gridplot children are tuples of (child, row, col)
+        if isinstance(child, tuple):
+            child = child[0]
+        _collect_visible(child, visible)
@@ -0,0 +1,138 @@
+import numpy as np
+from bokeh.models import CDSView, ColumnDataSource, GroupFilter
+
+from photodiag_web.density import density_rgba
+from photodiag_web.utils import RingBufferWindow
+
+
+class BufferStreamer:
+    """Keep a ColumnDataSource in sync with a `RingBuffer` by streaming only newly appended rows.
+
+    On every `update`, the rows appended to the buffer since the previous update are converted
+    to float32 arrays and streamed with a rollover equal to the buffer length, so that websocket
+    traffic and serialization time scale with the shot rate, not with the number of shots shown.
+    Rows are followed with a `RingBufferWindow`, so rows overwritten by the acquisition thread
+    while being copied are never sent.
+
+    Args:
+        source (ColumnDataSource): data source to update
+        columns (callable): returns a dict of new source columns for an array of buffer rows
+    """
+
+    def __init__(self, source, columns):
+        self.source = source
+        self.columns = columns
+
+        self._window = RingBufferWindow()
+
+    def reset(self):
+        """Clear the data source, the next update sends all retained buffer rows."""
+        self._window.clear()
+        self.source.data = {key: [] for key in self.source.data}
+
+    def update(self, buffer):
+        rebuilt, rows, _, _ = self._window.update(buffer)
+        rows = rows.astype(np.float32)
+
+        if rebuilt:
+            self.source.data = self.columns(rows)
+        elif len(rows):
+            self.source.stream(self.columns(rows), rollover=buffer.maxlen)
+
+
+class ImagePatcher:
+    """Update a single image in a ColumnDataSource by patching only its changed rows.
+
+    The full image is sent if its shape changes or most of its rows change.
+
+    Args:
+        source (ColumnDataSource): data source of an image glyph with `image`, `x`, `y`, `dw` and
+            `dh` columns
+        dtype (data-type, optional): data type of sent images, defaults to float32
+    """
+
+    def __init__(self, source, dtype=np.float32):
+        self.source = source
+        self.dtype = dtype
+        self._image = None
+
+    def reset(self):
+        self._image = None
+        self.source.data.update(image=[], x=[], y=[], dw=[], dh=[])
+
+    def update(self, image, x, y, dw, dh):
+        image = image.astype(self.dtype)
+        if self._image is None or self._image.shape != image.shape:
+            self.source.data.update(image=[image], x=[x], y=[y], dw=[dw], dh=[dh])
+            self._image = image
+            return
+
+        data = self.source.data
+        if (data["x"][0], data["y"][0], data["dw"][0], data["dh"][0]) != (x, y, dw, dh):
+            self.source.data.update(x=[x], y=[y], dw=[dw], dh=[dh])
+
+        changed = np.any(image != self._image, axis=1)
+        if np.count_nonzero(changed) > len(image) // 2:
+            self.source.data.update(image=[image])
+            self._image = image
+            return
+
+        # patch contiguous runs of changed rows, the source image array is patched in place
+        edges = np.flatnonzero(np.diff(changed, prepend=False, append=False))
+        patches = [
+            ((0, slice(start, stop), slice(None)), image[start:stop].ravel())
+            for start, stop in zip(edges[::2], edges[1::2])
+        ]
+        if patches:
+            self.source.patch({"image": patches})
+
+
+class DensityPlot:
+    """Draw shots of a `RollingHistogram2D` column pair as a density image with outlier circles.
+
+    Outliers of even and odd shots are added to the figure's "even" and "odd" legend items.
+
+    Args:
+        fig (figure): figure to draw into
+        pair_ind (int): index of the histogram column pair
+    """
+
+    def __init__(self, fig, pair_ind):
+        self.pair_ind = pair_ind
+
+        image_source = ColumnDataSource(dict(image=[], x=[], y=[], dw=[], dh=[]))
+        fig.image_rgba(source=image_source)
+        self._patcher = ImagePatcher(image_source, dtype=np.uint32)
+
+        self.outlier_source = ColumnDataSource(dict(parity=[], x=[], y=[]))
+        fig.circle(
+            source=self.outlier_source,
+            view=CDSView(filter=GroupFilter(column_name="parity", group="even")),
+            legend_label="even",
+        )
+        fig.circle(
+            source=self.outlier_source,
+            view=CDSView(filter=GroupFilter(column_name="parity", group="odd")),
+            line_color="red",
+            fill_color="red",
+            legend_label="odd",
+        )
+
+    def reset(self):
+        self._patcher.reset()
+        self.outlier_source.data.update(parity=[], x=[], y=[])
+
+    def update(self, histogram):
+        if not len(histogram):
+            self.reset()
+            return
+
+        even, odd, (x0, x1, y0, y1) = histogram.get(self.pair_ind)
+        self._patcher.update(density_rgba(even, odd), x=x0, y=y0, dw=x1 - x0, dh=y1 - y0)
+
+        outliers = histogram.outliers(self.pair_ind).astype(np.float32)
+        self.outlier_source.data = dict(
+            parity=np.where(outliers[:, 0] == 0, "even", "odd").tolist(),
+            x=outliers[:, 1],
+            y=outliers[:, 2],
+        )
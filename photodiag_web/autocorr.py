@@ -0,0 +1,165 @@
+from threading import Lock
+
+import numpy as np
+from lmfit.models import GaussianModel
+from scipy.fft import irfft, next_fast_len, rfft
+
+model = GaussianModel(prefix="g0_") + GaussianModel(prefix="g1_") + GaussianModel(prefix="g2_")
+
+
+def fft_size(n_pixels):
+    """Return a fast FFT length that avoids circular wrap-around for n_pixels long signals."""
+    return next_fast_len(2 * n_pixels - 1, real=True)
+
+
+def power_spectrum(spectra, n_fft=None):
+    """Compute power spectra of (a batch of) spectra along the last axis.
+
+    Args:
+        spectra (ndarray): array of shape (n_pixels,) or (n_shots, n_pixels)
+        n_fft (int, optional): zero-padded FFT length, defaults to `fft_size(n_pixels)`
+
+    Returns:
+        ndarray: power spectra of shape (..., n_fft // 2 + 1)
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    if n_fft is None:
+        n_fft = fft_size(spectra.shape[-1])
+
+    ft = rfft(spectra, n=n_fft, axis=-1)
+    return ft.real**2 + ft.imag**2
+
+
+def autocorrelation_from_power(power, n_pixels, n_fft=None):
+    """Convert power spectra back to autocorrelations (Wiener-Khinchin theorem).
+
+    The result matches `np.correlate(wf, wf, mode="same")` for n_pixels long waveforms.
+    """
+    if n_fft is None:
+        n_fft = fft_size(n_pixels)
+
+    autocorr = irfft(power, n=n_fft, axis=-1)
+    lags = np.arange(n_pixels) - n_pixels // 2
+    return np.take(autocorr, lags % n_fft, axis=-1)
+
+
+def autocorrelate(spectra):
+    """Compute "same"-mode autocorrelations of a batch of spectra along the last axis."""
+    spectra = np.asarray(spectra, dtype=float)
+    n_pixels = spectra.shape[-1]
+    n_fft = fft_size(n_pixels)
+
+    return autocorrelation_from_power(power_spectrum(spectra, n_fft), n_pixels, n_fft)
+
+
+def mean_autocorrelation(spectra):
+    """Compute the mean of "same"-mode autocorrelations over a batch of spectra.
+
+    Averaging is done on the power spectra, so only a single inverse FFT is needed.
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    n_pixels = spectra.shape[-1]
+    n_fft = fft_size(n_pixels)
+
+    power = power_spectrum(spectra, n_fft).reshape(-1, n_fft // 2 + 1).mean(axis=0)
+    return autocorrelation_from_power(power, n_pixels, n_fft)
+
+
+class PowerSpectrumAccumulator:
+    """Sliding window mean autocorrelation of spectra, without keeping per-shot history.
+
+    Power spectra of incoming shots are summed up in blocks of `block_size` shots, and only the
+    sums of the most recent blocks are kept. The window covers between `maxlen - block_size + 1`
+    and `maxlen` most recent shots, and its mean autocorrelation is available in O(n_pixels)
+    memory and time, regardless of the number of shots.
+
+    Args:
+        maxlen (int): maximum number of shots in the sliding window, rounded up to a multiple of
+            num_blocks
+        num_blocks (int, optional): number of blocks the window is split into, defaults to 10
+    """
+
+    def __init__(self, maxlen, num_blocks=10):
+        if maxlen < 1:
+            raise ValueError("Window length should be positive")
+
+        self.num_blocks = min(num_blocks, maxlen)
+        self.block_size = -(-maxlen // self.num_blocks)
+        self.maxlen = self.num_blocks * self.block_size
+
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._n_pixels = None
+            self._blocks = []  # sums of full blocks, the oldest first
+            self._full_sum = None
+            self._current = None
+            self._current_count = 0
+
+    def __len__(self):
+        return len(self._blocks) * self.block_size + self._current_count
+
+    def add(self, spectrum):
+        spectrum = np.asarray(spectrum)
+        n_pixels = spectrum.shape[-1]
+        power = power_spectrum(spectrum, fft_size(n_pixels))
+
+        with self._lock:
+            if n_pixels != self._n_pixels:
+                # restart on a change of spectrum length
+                self._n_pixels = n_pixels
+                self._blocks = []
+                self._full_sum = np.zeros_like(power)
+                self._current = np.zeros_like(power)
+                self._current_count = 0
+
+            if self._current_count == 0 and len(self._blocks) == self.num_blocks:
+                # make room for a new partial block
+                self._blocks.pop(0)
+                self._update_full_sum()
+
+            self._current += power
+            self._current_count += 1
+
+            if self._current_count == self.block_size:
+                self._blocks.append(self._current)
+                self._update_full_sum()
+                self._current = np.zeros_like(power)
+                self._current_count = 0
+
+    def _update_full_sum(self):
+        # recomputed rather than updated, to avoid accumulating rounding errors
+        self._full_sum = np.sum(self._blocks, axis=0)
+
+    def mean_autocorrelation(self):
+        """Return the mean "same"-mode autocorrelation of the window or None, if it is empty."""
+        with self._lock:
+            count = len(self)
+            if count == 0:
+                return None
+
+            power = (self._full_sum + self._current) / count
+            n_pixels = self._n_pixels
+
+        return autocorrelation_from_power(power, n_pixels)
+
+
+def fit_autocorr(y_autocorr, lags, params):
+    """Fit the three-Gaussian model to a normalized autocorrelation.
+
+    This function is meant to run in a worker process, so it returns only picklable data.
+
+    Returns:
+        dict: fitted parameter "values", "best_fit" curve, per-component "components" curves and
+            a text "report" of the fit
+    """
+    result = model.fit(y_autocorr, params, x=lags)
+
+    return dict(
+        values=dict(result.values),
+        best_fit=result.best_fit,
+        components=result.eval_components(x=lags),
+        report=result.fit_report(),
+    )
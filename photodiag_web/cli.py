@@ -1,11 +1,38 @@
+import argparse
 import os
 import subprocess
-import sys
 
 
 def main():
     app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
-    subprocess.run(["bokeh", "serve", app_path, *sys.argv[1:]], check=True)
+
+    parser = argparse.ArgumentParser(
+        prog="photodiag_web", description="All arguments not listed here go to 'bokeh serve'."
+    )
+    parser.add_argument(
+        "--replay", metavar="FILE", help="replay a recorded stream instead of reading from bsread"
+    )
+    parser.add_argument(
+        "--replay-rate",
+        type=float,
+        default=100,
+        help="replay rate in Hz, 0 to replay as fast as possible (default: 100)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve plain-text performance metrics at http://<host>:<port>/metrics",
+    )
+    args, bokeh_args = parser.parse_known_args()
+
+    env = dict(os.environ)
+    if args.replay:
+        env["PHOTODIAG_WEB_REPLAY"] = os.path.abspath(args.replay)
+        env["PHOTODIAG_WEB_REPLAY_RATE"] = str(args.replay_rate)
+    if args.metrics_port:
+        env["PHOTODIAG_WEB_METRICS_PORT"] = str(args.metrics_port)
+
+    subprocess.run(["bokeh", "serve", app_path, *bokeh_args], check=True, env=env)
 
 
 if __name__ == "__main__":
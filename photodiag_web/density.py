@@ -0,0 +1,158 @@
+import numpy as np
+
+from photodiag_web.utils import RingBufferWindow
+
+EVEN_RGB = (31, 119, 180)
+ODD_RGB = (255, 0, 0)
+
+
+class RollingHistogram2D:
+    """2D histograms of pairs of columns over the shots retained in a `RingBuffer`.
+
+    Buffer rows are expected to be (parity, values...). For every pair of value columns, even
+    and odd shots are binned into separate histograms. Histograms are updated incrementally: rows
+    appended to the buffer since the previous update are added, and rows dropped from the buffer
+    are subtracted, based on the stored bin indices of all retained rows.
+
+    Bin ranges cover the dense core of the data: the range between the `quantile` and
+    `1 - quantile` quantiles, extended by `margin` on both sides. Values outside of it are kept as
+    outliers. Histograms are rebuilt with new ranges from all retained rows, if the fraction of
+    outliers exceeds `max_outliers`.
+
+    Args:
+        pairs (Iterable): tuples of x and y column indices
+        num_bins (int, optional): number of bins along each axis
+        quantile (float, optional): quantile that defines the dense core of the data
+        margin (float, optional): relative margin around the dense core
+        max_outliers (float, optional): maximum fraction of outliers before a rebuild
+    """
+
+    def __init__(self, pairs, num_bins=200, quantile=0.001, margin=0.1, max_outliers=0.01):
+        self.pairs = list(pairs)
+        self.num_bins = num_bins
+        self.quantile = quantile
+        self.margin = margin
+        self.max_outliers = max_outliers
+
+        self._window = RingBufferWindow()
+        self._ranges = None
+        self._indices = None
+        self._counts = None
+        self._num_outliers = None
+
+    def _bin(self, rows):
+        nb = self.num_bins
+        parity = (rows[:, 0] != 0).astype(np.int64)
+        indices = np.empty((len(rows), len(self.pairs)), dtype=np.int64)
+        for ind, ((x_col, y_col), (x0, x1, y0, y1)) in enumerate(zip(self.pairs, self._ranges)):
+            x = (rows[:, x_col] - x0) * (nb / (x1 - x0))
+            y = (rows[:, y_col] - y0) * (nb / (y1 - y0))
+            # NaN values fail the comparisons and become outliers
+            valid = (x >= 0) & (x < nb) & (y >= 0) & (y < nb)
+            x_ind = np.where(valid, x, 0).astype(np.int64)
+            y_ind = np.where(valid, y, 0).astype(np.int64)
+            indices[:, ind] = np.where(valid, (parity * nb + x_ind) * nb + y_ind, -1)
+
+        return indices
+
+    def _add(self, indices, sign):
+        for ind in range(len(self.pairs)):
+            col = indices[:, ind]
+            valid = col >= 0
+            self._counts[ind] += sign * np.bincount(col[valid], minlength=self._counts.shape[1])
+            self._num_outliers[ind] += sign * np.count_nonzero(~valid)
+
+    def _core_range(self, values):
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return 0.0, 1.0
+
+        low, high = np.quantile(values, (self.quantile, 1 - self.quantile))
+        span = high - low
+        if span == 0:
+            span = abs(high) or 1.0
+
+        return low - self.margin * span, high + self.margin * span
+
+    def _rebuild(self, rows, slots, maxlen):
+        self._ranges = [
+            (*self._core_range(rows[:, x_col]), *self._core_range(rows[:, y_col]))
+            for x_col, y_col in self.pairs
+        ]
+        self._counts = np.zeros((len(self.pairs), 2 * self.num_bins**2), dtype=np.int64)
+        self._num_outliers = np.zeros(len(self.pairs), dtype=np.int64)
+        self._indices = np.full((maxlen, len(self.pairs)), -1, dtype=np.int64)
+
+        indices = self._bin(rows)
+        self._add(indices, 1)
+        self._indices[slots] = indices
+
+    def clear(self):
+        self._window.clear()
+
+    def update(self, buffer):
+        """Update histograms with the rows appended to the buffer since the previous update."""
+        rebuilt, rows, slots, dropped = self._window.update(buffer)
+        if rebuilt:
+            self._rebuild(rows, slots, buffer.maxlen)
+            return
+
+        if not len(rows):
+            return
+
+        indices = self._bin(rows)
+        self._add(self._indices[dropped], -1)
+        self._add(indices, 1)
+        self._indices[slots] = indices
+
+        if np.any(self._num_outliers > self.max_outliers * len(self._window)):
+            self._window.clear()
+            self.update(buffer)
+
+    def __len__(self):
+        return len(self._window)
+
+    def get(self, pair_ind):
+        """Return histograms of a column pair.
+
+        Returns:
+            tuple: even and odd shot counts of shape (num_bins, num_bins), indexed by x and y bins,
+                and the (x0, x1, y0, y1) bin range
+        """
+        nb = self.num_bins
+        even, odd = self._counts[pair_ind].reshape(2, nb, nb)
+        return even, odd, self._ranges[pair_ind]
+
+    def outliers(self, pair_ind):
+        """Return parity, x and y values of retained shots outside of bin ranges of a pair."""
+        rows, slots = self._window.retained()
+        is_outlier = self._indices[slots, pair_ind] < 0
+
+        x_col, y_col = self.pairs[pair_ind]
+        return rows[is_outlier][:, [0, x_col, y_col]]
+
+
+def density_rgba(even, odd):
+    """Render even and odd shot counts to a packed RGBA image for bokeh's `image_rgba`.
+
+    Opacity follows the log of the total counts, and color is a mix of even and odd colors
+    according to their fraction in each bin.
+
+    Args:
+        even (ndarray): even shot counts indexed by x and y bins
+        odd (ndarray): odd shot counts indexed by x and y bins
+
+    Returns:
+        ndarray: uint32 image indexed by y and x bins
+    """
+    total = even + odd
+    max_total = total.max()
+    alpha = np.log1p(total) / np.log1p(max_total) if max_total else np.zeros(total.shape)
+    odd_fraction = odd / np.maximum(total, 1)
+
+    rgba = np.empty((*total.shape, 4), dtype=np.uint8)
+    for channel, (even_val, odd_val) in enumerate(zip(EVEN_RGB, ODD_RGB)):
+        rgba[..., channel] = even_val + (odd_val - even_val) * odd_fraction
+    rgba[..., 3] = 255 * alpha
+
+    return rgba.transpose(1, 0, 2).copy().view(np.uint32)[..., 0]
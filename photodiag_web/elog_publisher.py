@@ -0,0 +1,167 @@
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import local
+
+import elog
+import urllib3
+from bokeh.io.export import get_layout_html, wait_until_render_complete
+from bokeh.io.webdriver import webdriver_control
+from PIL import Image
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)  # suppress elog warning
+
+logger = logging.getLogger(__name__)
+
+ELOG_URL = "https://elog-gfa.psi.ch/SF-Photonics-Data"
+
+_ROOT_SIZE_SCRIPT = """
+const {width, height} = Bokeh.index.roots[0].el.getBoundingClientRect()
+return [Math.round(width), Math.round(height), window.devicePixelRatio]
+"""
+
+
+class ElogPublisher:
+    """Publish elog entries with figure attachments in background threads.
+
+    Figures are serialized to standalone html on the calling (bokeh event loop) thread, which is
+    fast and safe with respect to the document state. Rendering to png with a headless browser
+    and posting to elog happen in worker threads, each of which keeps its own persistent
+    webdriver.
+
+    Args:
+        url (str, optional): elog logbook url, defaults to ELOG_URL
+        num_workers (int, optional): number of worker threads and webdrivers, defaults to 1
+        render_timeout (int, optional): maximum time in seconds to wait for a figure to render
+    """
+
+    def __init__(self, url=ELOG_URL, num_workers=1, render_timeout=10):
+        self.url = url
+        self.num_workers = num_workers
+        self.render_timeout = render_timeout
+        self._executor = None
+        self._local = local()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.num_workers, thread_name_prefix="elog_publisher"
+            )
+        return self._executor
+
+    def _get_driver(self):
+        driver = getattr(self._local, "driver", None)
+        if driver is None:
+            driver = webdriver_control.create()
+            self._local.driver = driver
+        return driver
+
+    def _reset_driver(self):
+        driver = getattr(self._local, "driver", None)
+        self._local.driver = None
+        if driver is not None:
+            try:
+                webdriver_control.terminate(driver)
+            except Exception as e:
+                logger.debug(e)
+
+    def _render_png(self, html, filename):
+        driver = self._get_driver()
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".html", delete=False) as f:
+            f.write(html)
+
+        try:
+            driver.get(f"file://{f.name}")
+            wait_until_render_complete(driver, self.render_timeout)
+
+            width, height, dpr = driver.execute_script(_ROOT_SIZE_SCRIPT)
+            # the window might be too small for the layout, in which case the page is re-rendered
+            driver.set_window_size(width * dpr + 100, height * dpr + 100)
+            png = driver.get_screenshot_as_png()
+        finally:
+            os.unlink(f.name)
+
+        Image.open(BytesIO(png)).crop((0, 0, width * dpr, height * dpr)).save(filename)
+
+    def _publish(self, pages, message, attributes):
+        logbook = elog.open(self.url, user="sf-photodiag", password="")
+
+        attachments = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for html, figure_name in pages:
+                figure_path = os.path.join(temp_dir, figure_name)
+                try:
+                    self._render_png(html, figure_path)
+                except Exception:
+                    # the browser might have crashed, start a new one for the next job
+                    self._reset_driver()
+                    raise
+                attachments.append(figure_path)
+
+            msg_id = logbook.post(
+                message,
+                attributes=attributes,
+                attachments=attachments,
+                suppress_email_notification=True,
+            )
+
+        return msg_id
+
+    def entry_url(self, msg_id):
+        """Return the url of an elog entry."""
+        return f"{self.url}/{msg_id}"
+
+    def submit(self, figures, message, attributes, callback=None, errback=None):
+        """Queue an elog entry.
+
+        Must be called from the bokeh event loop thread, e.g. in a widget callback.
+
+        Args:
+            figures (Iterable): an Iterable of tuples of bokeh Plot instances and a corresponding
+                file names
+            message (str): elog entry message text
+            attributes (dict): elog entry attributes dictionary
+            callback (callable, optional): called with the url of the elog entry, once it is
+                created
+            errback (callable, optional): called with the exception, if publishing fails. Defaults
+                to logging the exception.
+
+        Returns:
+            Future: a future of the elog message id
+        """
+        pages = [(get_layout_html(figure), figure_name) for figure, figure_name in figures]
+        future = self._get_executor().submit(self._publish, pages, message, attributes)
+
+        def _done(future):
+            try:
+                msg_id = future.result()
+            except Exception as e:
+                if errback is None:
+                    logger.error(e)
+                else:
+                    errback(e)
+            else:
+                if callback is not None:
+                    callback(self.entry_url(msg_id))
+
+        future.add_done_callback(_done)
+
+        return future
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+elog_publisher = ElogPublisher()
+
+
+def push_elog(figures, message, attributes, callback=None, errback=None):
+    """Push an entry to elog at https://elog-gfa.psi.ch/SF-Photonics-Data in the background.
+
+    See `ElogPublisher.submit` for the description of arguments.
+    """
+    return elog_publisher.submit(figures, message, attributes, callback, errback)
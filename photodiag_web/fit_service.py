@@ -0,0 +1,152 @@
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    def __init__(self, doc, func, args, callback, errback):
+        self.doc = doc
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+
+
+def _report_error(job, error):
+    if job.errback is None:
+        logger.error(error)
+    else:
+        job.errback(error)
+
+
+class FitService:
+    """Run fits in a process pool, off the bokeh event loop.
+
+    Jobs are grouped by a key and run one after another within each group. Results are delivered
+    to the session through `doc.add_next_tick_callback`, so callbacks may safely update models.
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = min(4, os.cpu_count() or 1)
+
+        self.max_workers = max_workers
+        self.num_dropped = 0
+        self._executor = None
+        self._queues = {}
+        self._running = set()
+        self._lock = Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # "spawn" avoids forking a process with running Channel Access and bsread threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def submit(self, doc, func, args, callback, key=None, drop_stale=True, errback=None):
+        """Submit a fit job.
+
+        Args:
+            doc (Document): bokeh document of the session that receives the result
+            func (callable): picklable module-level function to run in a worker process
+            args (tuple): picklable arguments of func
+            callback (callable): async callback, called with the result on the document's thread
+            key (hashable, optional): group of jobs that run sequentially, defaults to a unique
+                group per submission
+            drop_stale (bool, optional): drop jobs of the same group that have not started yet,
+                so only the most recent one runs next. Defaults to True.
+            errback (callable, optional): called with the exception if the job fails, defaults to
+                logging the exception
+        """
+        if key is None:
+            key = object()
+
+        job = _Job(doc, func, args, callback, errback)
+        with self._lock:
+            queue = self._queues.setdefault(key, deque())
+            if drop_stale:
+                self.num_dropped += len(queue)
+                queue.clear()
+            queue.append(job)
+
+            if key in self._running:
+                return
+
+            failed = self._start_next(key)
+
+        for failed_job, error in failed:
+            _report_error(failed_job, error)
+
+    def _start_next(self, key):
+        """Start the next job of a group, must be called with the lock held.
+
+        Returns:
+            list: jobs that could not be submitted with their exceptions, their errbacks should be
+                called after releasing the lock
+        """
+        failed = []
+        queue = self._queues.get(key)
+        while queue:
+            job = queue.popleft()
+            executor = self._get_executor()
+            try:
+                future = executor.submit(job.func, *job.args)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._discard_executor(executor)
+                failed.append((job, e))
+                continue
+
+            self._running.add(key)
+            future.add_done_callback(partial(self._job_done, key, job, executor))
+            return failed
+
+        self._queues.pop(key, None)
+        self._running.discard(key)
+        return failed
+
+    def _discard_executor(self, executor):
+        # a worker died, so the pool is not usable anymore, the next job starts a new one
+        if self._executor is executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _job_done(self, key, job, executor, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                with self._lock:
+                    self._discard_executor(executor)
+            _report_error(job, e)
+        else:
+            try:
+                job.doc.add_next_tick_callback(partial(job.callback, result))
+            except Exception as e:
+                # the session might have been destroyed in the meantime
+                logger.debug(e)
+
+        with self._lock:
+            failed = self._start_next(key)
+
+        for failed_job, error in failed:
+            _report_error(failed_job, error)
+
+    def shutdown(self):
+        with self._lock:
+            self._queues.clear()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+fit_service = FitService()
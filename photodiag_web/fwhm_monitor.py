@@ -0,0 +1,73 @@
+import logging
+from threading import Lock, Thread
+
+import epics
+import numpy as np
+
+from photodiag_web.utils import RingBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class FwhmMonitor:
+    """Process-wide monitor of FWHM values reported by spectrometers.
+
+    The FWHM channel of a device is resolved once, in a background thread on the first request:
+    `{device}:FIT-FWHM` if it connects, otherwise `{device}:SPECTRUM_FWHM`. The channel is then
+    monitored for the lifetime of the process, keeping a rolling buffer of its recent values, so
+    that any number of sessions can read the mean without Channel Access traffic.
+
+    Args:
+        num_values (int, optional): number of recent values to average
+        connection_timeout (float, optional): timeout in seconds to probe the FIT-FWHM channel
+    """
+
+    def __init__(self, num_values=20, connection_timeout=5):
+        self.num_values = num_values
+        self.connection_timeout = connection_timeout
+        self._buffers = {}
+        self._pvs = {}
+        self._lock = Lock()
+
+    def monitor(self, device):
+        """Start monitoring the FWHM of a device in the background, if it is not monitored yet."""
+        with self._lock:
+            if device in self._buffers:
+                return
+
+            self._buffers[device] = RingBuffer(self.num_values)
+
+        Thread(target=self._connect, args=(device,), daemon=True).start()
+
+    def _connect(self, device):
+        # TODO: remove the fallback after channel names are fixed for all devices
+        pv = epics.PV(f"{device}:FIT-FWHM")
+        if not pv.wait_for_connection(timeout=self.connection_timeout):
+            pv.disconnect()
+            pv = epics.PV(f"{device}:SPECTRUM_FWHM")
+        logger.info(f"Monitoring {pv.pvname}")
+
+        buffer = self._buffers[device]
+
+        def _callback(value=None, **_):
+            if value is not None:
+                buffer.append(value)
+
+        pv.add_callback(_callback)
+        self._pvs[device] = pv
+
+    def get(self, device):
+        """Return the mean of recent FWHM values of a device.
+
+        The device gets monitored from the first call on, so the result is None until the first
+        values arrive.
+        """
+        self.monitor(device)
+        buffer = self._buffers[device]
+        if not buffer:
+            return None
+
+        return float(np.mean(buffer.view()))
+
+
+fwhm_monitor = FwhmMonitor()
@@ -0,0 +1,152 @@
+import time
+from weakref import WeakSet
+
+import numpy as np
+from bokeh.models import Div
+from tornado.web import Application, RequestHandler
+
+from photodiag_web.fit_service import fit_service
+from photodiag_web.stream_hub import stream_hub
+from photodiag_web.utils import RingBuffer
+
+_panel_stats = WeakSet()
+
+
+class PanelStats:
+    """Performance counters of a panel.
+
+    Shot counters and processing times are recorded from the acquisition thread via `add_shot`
+    (or `add_shots` for panels processing shots in batches),
+    refresh times by the refresh scheduler around each periodic plot update. A panel can call
+    `refresh_computed` in its plot update to split the refresh time into data processing
+    ("compute") and updates of bokeh models, which includes their serialization ("update"). Panels
+    with background fits record the time from submission to the result via `add_fit`.
+
+    Args:
+        panel (str): panel name
+        session_id (str, optional): bokeh session id
+        num_samples (int, optional): number of recent samples to average times over
+    """
+
+    def __init__(self, panel, session_id=None, num_samples=100):
+        self.panel = panel
+        self.session_id = session_id
+
+        self.num_received = 0
+        self.num_rejected = 0
+        self.stream = None
+
+        self._process_times = RingBuffer(num_samples)
+        self._compute_times = RingBuffer(num_samples)
+        self._update_times = RingBuffer(num_samples)
+        self._fit_times = RingBuffer(num_samples)
+        self._refresh_start = None
+        self._refresh_computed = None
+        self._div = None
+
+        _panel_stats.add(self)
+
+    @property
+    def num_dropped(self):
+        """Number of values dropped by the stream hub or a callback queue, if the panel lags."""
+        return 0 if self.stream is None else self.stream.num_dropped
+
+    def add_shot(self, start, accepted=True):
+        """Record a received shot, processing of which began at `start` (time.perf_counter)."""
+        self._process_times.append(time.perf_counter() - start)
+        self.num_received += 1
+        if not accepted:
+            self.num_rejected += 1
+
+    def add_shots(self, start, num_shots):
+        """Record a batch of accepted shots, processing of which began at `start`."""
+        self._process_times.append((time.perf_counter() - start) / num_shots)
+        self.num_received += num_shots
+
+    def add_fit(self, start):
+        """Record a fit result, which was submitted at `start` (time.perf_counter)."""
+        self._fit_times.append(time.perf_counter() - start)
+
+    def refresh_started(self):
+        self._refresh_start = time.perf_counter()
+        self._refresh_computed = None
+
+    def refresh_computed(self):
+        self._refresh_computed = time.perf_counter()
+
+    def refresh_finished(self):
+        if self._refresh_start is None:
+            return
+
+        end = time.perf_counter()
+        computed = end if self._refresh_computed is None else self._refresh_computed
+        self._compute_times.append(computed - self._refresh_start)
+        self._update_times.append(end - computed)
+        self._refresh_start = None
+
+    def mean_times(self):
+        """Return mean shot processing, refresh compute, refresh update and fit times in seconds."""
+        return tuple(
+            float(np.mean(buffer.view())) if buffer else 0.0
+            for buffer in (
+                self._process_times,
+                self._compute_times,
+                self._update_times,
+                self._fit_times,
+            )
+        )
+
+    def summary(self):
+        process_time, compute_time, update_time, fit_time = self.mean_times()
+        rejected = f"{self.num_rejected} ({self.num_rejected / max(self.num_received, 1):.1%})"
+        summary = (
+            f"Shots: {self.num_received}, rejected: {rejected}, dropped: {self.num_dropped} | "
+            f"Processing: {process_time * 1e3:.3f} ms/shot | "
+            f"Refresh compute: {compute_time * 1e3:.1f} ms, update: {update_time * 1e3:.1f} ms"
+        )
+        if self._fit_times:
+            summary += f" | Fit: {fit_time * 1e3:.0f} ms"
+
+        return summary
+
+    def create_div(self):
+        """Return a Div with a compact stats summary, updated by `update_div`."""
+        self._div = Div(text=self.summary(), styles={"font-size": "small", "color": "gray"})
+        return self._div
+
+    async def update_div(self):
+        self._div.text = self.summary()
+
+
+def render_metrics():
+    """Return metrics of all live panels and shared services in a plain-text exposition format."""
+    lines = [
+        f"photodiag_web_stream_hub_streams {stream_hub.num_streams}",
+        f"photodiag_web_fit_service_dropped_total {fit_service.num_dropped}",
+    ]
+
+    for stats in sorted(_panel_stats, key=lambda s: (str(s.session_id), s.panel)):
+        labels = f'panel="{stats.panel}",session="{stats.session_id}"'
+        process_time, compute_time, update_time, fit_time = stats.mean_times()
+        lines += [
+            f"photodiag_web_shots_received_total{{{labels}}} {stats.num_received}",
+            f"photodiag_web_shots_rejected_total{{{labels}}} {stats.num_rejected}",
+            f"photodiag_web_shots_dropped_total{{{labels}}} {stats.num_dropped}",
+            f"photodiag_web_shot_processing_seconds{{{labels}}} {process_time:.6g}",
+            f"photodiag_web_refresh_compute_seconds{{{labels}}} {compute_time:.6g}",
+            f"photodiag_web_refresh_update_seconds{{{labels}}} {update_time:.6g}",
+            f"photodiag_web_fit_seconds{{{labels}}} {fit_time:.6g}",
+        ]
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(render_metrics())
+
+
+def start_metrics_server(port):
+    """Serve metrics at http://<host>:<port>/metrics on the current tornado IOLoop."""
+    return Application([(r"/metrics", MetricsHandler)]).listen(port)
@@ -0,0 +1,145 @@
+import logging
+import time
+from copy import deepcopy
+from threading import Lock, Thread
+
+from cam_server_client import PipelineClient
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineConfigCache:
+    """Process-wide cache of camera_server pipeline configs.
+
+    Configs are fetched on the first request, unless they were prefetched. Once a config is older
+    than `ttl` seconds, the cached copy is still returned, while it is refetched in a background
+    thread, so that callers on the event loop only wait for a request when a config has never been
+    fetched. Saving a config through the cache refetches its entry and notifies listeners, e.g.
+    panels of other sessions showing the same pipeline. Returned configs are copies, which callers
+    are free to modify.
+
+    Args:
+        ttl (float, optional): time in seconds after which a config is refetched
+        client_factory (callable, optional): returns a client for the camera_server
+    """
+
+    def __init__(self, ttl=60, client_factory=PipelineClient):
+        self.ttl = ttl
+        self.client_factory = client_factory
+
+        self._client = None
+        self._configs = {}
+        self._refreshing = set()
+        self._listeners = []
+        self._lock = Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.client_factory()
+        return self._client
+
+    def _fetch(self, pipeline_name):
+        fetch_time = time.monotonic()
+        config = self.client.get_pipeline_config(pipeline_name)
+        with self._lock:
+            cached = self._configs.get(pipeline_name)
+            # do not replace a config fetched later, e.g. right after a save
+            if cached is None or cached[0] <= fetch_time:
+                cached = (fetch_time, config)
+                self._configs[pipeline_name] = cached
+
+        return cached[1]
+
+    def _refresh(self, pipeline_name):
+        try:
+            self._fetch(pipeline_name)
+        except Exception as e:
+            logger.error(f"Can not refresh {pipeline_name} config: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(pipeline_name)
+
+    def get(self, pipeline_name):
+        """Return a copy of a pipeline config.
+
+        A config that is not cached is fetched, an expired one is returned as is and refetched in
+        a background thread.
+        """
+        with self._lock:
+            cached = self._configs.get(pipeline_name)
+            refresh = (
+                cached is not None
+                and time.monotonic() - cached[0] > self.ttl
+                and pipeline_name not in self._refreshing
+            )
+            if refresh:
+                self._refreshing.add(pipeline_name)
+
+        if cached is None:
+            return deepcopy(self._fetch(pipeline_name))
+
+        if refresh:
+            Thread(target=self._refresh, args=(pipeline_name,), daemon=True).start()
+
+        return deepcopy(cached[1])
+
+    def save(self, pipeline_name, config):
+        """Save a pipeline config to the camera_server and notify listeners.
+
+        The saved config is fetched back into the cache before listeners are called, so it
+        should be called from a worker thread, and listeners get the new config without a request.
+        """
+        self.client.save_pipeline_config(pipeline_name, config)
+        self.invalidate(pipeline_name)
+        try:
+            config = self._fetch(pipeline_name)
+        except Exception as e:
+            logger.error(f"Can not fetch saved {pipeline_name} config: {e}")
+            return
+
+        with self._lock:
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            try:
+                listener(pipeline_name, deepcopy(config))
+            except Exception as e:
+                logger.error(e)
+
+    def invalidate(self, pipeline_name=None):
+        """Drop a cached pipeline config, or all of them, if `pipeline_name` is None."""
+        with self._lock:
+            if pipeline_name is None:
+                self._configs.clear()
+            else:
+                self._configs.pop(pipeline_name, None)
+
+    def stop_instance(self, pipeline_name):
+        """Stop a running pipeline instance, e.g. for it to restart with a newly saved config."""
+        self.client.stop_instance(pipeline_name)
+
+    def prefetch(self, pipeline_names):
+        """Fetch pipeline configs in a background thread."""
+
+        def _prefetch():
+            for pipeline_name in pipeline_names:
+                try:
+                    self._fetch(pipeline_name)
+                except Exception as e:
+                    logger.error(f"Can not prefetch {pipeline_name} config: {e}")
+
+        Thread(target=_prefetch, daemon=True).start()
+
+    def add_listener(self, callback):
+        """Call `callback(pipeline_name, config)` in the saving thread after a config is saved."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+
+pipeline_configs = PipelineConfigCache()
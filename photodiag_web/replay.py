@@ -0,0 +1,171 @@
+import argparse
+import gzip
+import time
+from collections import namedtuple
+
+import bsread
+import numpy as np
+
+# Minimal stand-ins for bsread message classes, as far as they are used by the panels
+Value = namedtuple("Value", ["value"])
+MessageData = namedtuple("MessageData", ["pulse_id", "data"])
+Message = namedtuple("Message", ["data"])
+
+
+def _read_record(file):
+    """Read the next .npy record from a file object, return None at the end of the file.
+
+    Unlike `np.load`, that seeks back after checking the magic string, this only reads forward,
+    which avoids rewinding and decompressing a gzip file again from the start.
+    """
+    if not file.peek(1):
+        return None
+
+    return np.lib.format.read_array(file, allow_pickle=False)
+
+
+class StreamRecorder:
+    """Record bsread messages to a gzip-compressed file of consecutive .npy records.
+
+    The file starts with an array of channel names, followed by pulse id, a mask of channels
+    present in the message and their values for every recorded message. No pickling is involved.
+
+    Args:
+        filename (str): output file name
+        channels (Iterable): channel names to record
+    """
+
+    def __init__(self, filename, channels):
+        self.channels = list(channels)
+        self._file = gzip.open(filename, "wb", compresslevel=1)
+        np.save(self._file, np.array(self.channels), allow_pickle=False)
+
+    def write(self, message):
+        msg_data = message.data
+        values = [msg_data.data.get(ch) for ch in self.channels]
+        values = [None if val is None else val.value for val in values]
+        mask = np.array([val is not None for val in values])
+
+        np.save(self._file, np.array([msg_data.pulse_id], dtype=np.int64), allow_pickle=False)
+        np.save(self._file, mask, allow_pickle=False)
+        for val in values:
+            if val is not None:
+                np.save(self._file, np.asarray(val), allow_pickle=False)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def record(filename, channels, num_messages, source_factory=bsread.source):
+    """Record a number of messages of a bsread stream to a file."""
+    with source_factory(channels=list(channels)) as stream:
+        with StreamRecorder(filename, channels) as recorder:
+            for _ in range(num_messages):
+                recorder.write(stream.receive())
+
+
+class ReplaySource:
+    """A drop-in replacement for `bsread.source`, that replays a recorded stream.
+
+    Args:
+        filename (str): file written by `StreamRecorder`
+        channels (Iterable, optional): channels to return, channels that were not recorded have
+            None values. Defaults to all recorded channels.
+        rate (float, optional): message rate in Hz, None to replay as fast as possible
+        loop (bool, optional): restart from the beginning at the end of the file, otherwise
+            `receive` returns None. Defaults to True.
+        receive_timeout (int, optional): timeout in ms of `receive` at the end of the file, if not
+            looping
+    """
+
+    def __init__(self, filename, channels=None, rate=None, loop=True, receive_timeout=None, **_):
+        self.filename = filename
+        self.rate = rate
+        self.loop = loop
+        self.receive_timeout = receive_timeout
+
+        self._file = None
+        self._recorded_channels = []
+        self._channels = None if channels is None else list(channels)
+        self._next_time = None
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+
+        self._file = gzip.open(self.filename, "rb")
+        self._recorded_channels = _read_record(self._file).tolist()
+        if self._channels is None:
+            self._channels = self._recorded_channels
+
+    def _read_message(self):
+        pulse_id = _read_record(self._file)
+        if pulse_id is None:
+            return None
+
+        pulse_id = int(pulse_id[0])
+        mask = _read_record(self._file)
+        recorded = {}
+        for ch, present in zip(self._recorded_channels, mask):
+            value = _read_record(self._file) if present else None
+            if value is not None and value.ndim == 0:
+                value = value.item()
+            recorded[ch] = value
+
+        data = {ch: Value(recorded.get(ch)) for ch in self._channels}
+        return Message(MessageData(pulse_id, data))
+
+    def receive(self):
+        if self._file is None:
+            self._open()
+
+        message = self._read_message()
+        if message is None:
+            if not self.loop:
+                if self.receive_timeout is not None:
+                    time.sleep(self.receive_timeout / 1000)
+                return None
+
+            self._open()
+            message = self._read_message()
+
+        if self.rate:
+            now = time.monotonic()
+            if self._next_time is None or self._next_time < now:
+                self._next_time = now
+            else:
+                time.sleep(self._next_time - now)
+            self._next_time += 1 / self.rate
+
+        return message
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a bsread stream for offline replay.")
+    parser.add_argument("filename", help="output file name")
+    parser.add_argument("channels", nargs="+", help="bsread channel names")
+    parser.add_argument("-n", "--num-messages", type=int, default=1000)
+    args = parser.parse_args()
+
+    record(args.filename, args.channels, args.num_messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import epics
+
+logger = logging.getLogger(__name__)
+
+
+class MotorPositioner:
+    """Move an `epics.Motor` and wait for the move to complete."""
+
+    def __init__(self, pv_name):
+        self.name = pv_name
+        self.motor = epics.Motor(pv_name)
+
+    def get_position(self):
+        return self.motor.get_position()
+
+    def move(self, position):
+        val = self.motor.move(position, wait=True)
+        if val != 0:
+            if val == -12:
+                raise ValueError(
+                    f"Motor position outside soft limits: {self.motor.LLM} {self.motor.HLM}"
+                )
+            raise ValueError(f"Error moving the motor {self.name}, error value {val}")
+
+
+class PVPositioner:
+    """Put a value to a PV and wait for the put to complete."""
+
+    def __init__(self, pv_name):
+        self.name = pv_name
+        self.pv = epics.PV(pv_name)
+
+    def get_position(self):
+        return self.pv.get()
+
+    def move(self, position):
+        self.pv.put(position, wait=True)
+
+
+def scan(positioner, positions, acquire, analyze, stop_event=None, return_position=None):
+    """Scan a positioner, acquiring data at each position and analysing it in the background.
+
+    Analysis of a point runs in a worker thread, while the positioner already moves to the next
+    point and acquires its data, so the scan time is close to the motion and acquisition time.
+    Points are analysed one at a time in the scan order.
+
+    Args:
+        positioner (MotorPositioner | PVPositioner): scanned positioner
+        positions (Iterable): positions to scan
+        acquire (callable): called with a position after the move, returns the acquired data
+        analyze (callable): called with a position and its data, returns the analysis result
+        stop_event (Event, optional): stop scanning, once set. Results of the already acquired
+            points are still returned.
+        return_position (float, optional): position to move to after the scan, even if it fails.
+            Defaults to the initial position.
+
+    Returns:
+        list: analysis results of the scanned points
+    """
+    if return_position is None:
+        return_position = positioner.get_position()
+
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="scan_analysis") as executor:
+            for pos in positions:
+                if stop_event is not None and stop_event.is_set():
+                    break
+
+                positioner.move(pos)
+                data = acquire(pos)
+                futures.append(executor.submit(analyze, pos, data))
+
+            results = [future.result() for future in futures]
+
+    except BaseException:
+        # a failing move back should not hide the original error
+        try:
+            positioner.move(return_position)
+        except Exception as e:
+            logger.error(f"Can not move {positioner.name} back to {return_position}: {e}")
+        raise
+
+    positioner.move(return_position)
+    return results
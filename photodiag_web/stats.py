@@ -0,0 +1,191 @@
+from collections import namedtuple
+
+import numpy as np
+
+from photodiag_web.utils import RingBufferWindow
+
+PairStats = namedtuple(
+    "PairStats", ["n", "mean_x", "mean_y", "std_x", "std_y", "cov", "r", "slope"]
+)
+
+
+# n, mean_x, mean_y, m2_x, m2_y, c_xy
+_NO_MOMENTS = (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+
+def _moments(x, y):
+    n = len(x)
+    if not n:
+        return _NO_MOMENTS
+
+    mean_x = x.mean()
+    mean_y = y.mean()
+    dx = x - mean_x
+    dy = y - mean_y
+    return n, mean_x, mean_y, dx @ dx, dy @ dy, dx @ dy
+
+
+def _combine(a, b, sign):
+    """Merge moments `b` into `a` (sign=1), or subtract `b` from moments `a` including it (-1)."""
+    n_a, mean_xa, mean_ya, m2_xa, m2_ya, c_a = a
+    n_b, mean_xb, mean_yb, m2_xb, m2_yb, c_b = b
+
+    if sign > 0:
+        n = n_a + n_b
+        dx = mean_xb - mean_xa
+        dy = mean_yb - mean_ya
+        f = n_a * n_b / n
+        return (
+            n,
+            mean_xa + dx * n_b / n,
+            mean_ya + dy * n_b / n,
+            m2_xa + m2_xb + dx * dx * f,
+            m2_ya + m2_yb + dy * dy * f,
+            c_a + c_b + dx * dy * f,
+        )
+
+    n = n_a - n_b
+    if n <= 0:
+        return _NO_MOMENTS
+
+    mean_x = (n_a * mean_xa - n_b * mean_xb) / n
+    mean_y = (n_a * mean_ya - n_b * mean_yb) / n
+    dx = mean_xb - mean_x
+    dy = mean_yb - mean_y
+    f = n * n_b / n_a
+    return (
+        n,
+        mean_x,
+        mean_y,
+        m2_xa - m2_xb - dx * dx * f,
+        m2_ya - m2_yb - dy * dy * f,
+        c_a - c_b - dx * dy * f,
+    )
+
+
+class RollingStats:
+    """Sliding window statistics of pairs of columns over the shots retained in a `RingBuffer`.
+
+    Buffer rows are expected to be (parity, values...). For every pair of value columns, even and
+    odd shots are tracked separately by their counts, means, sums of squared deviations and
+    co-moments (Welford's algorithm). Updates are incremental: rows appended to the buffer since
+    the previous update are merged in, and rows dropped from the buffer are subtracted, with the
+    parallel variant of the algorithm applied to each batch. Shots with non-finite values of a
+    pair are skipped for that pair.
+
+    Dropped rows are already overwritten in the buffer, so a copy of the pair values of all
+    retained rows is kept, from which the statistics are also rebuilt every time the whole window
+    has been replaced, to avoid accumulating rounding errors.
+
+    Args:
+        pairs (Iterable): tuples of x and y column indices
+    """
+
+    def __init__(self, pairs):
+        self.pairs = list(pairs)
+
+        self._window = RingBufferWindow()
+        self._rows = None
+        # moments per pair and parity
+        self._moments = None
+        self._num_updates = 0
+
+    def _select(self, rows):
+        columns = [0, *(col for pair in self.pairs for col in pair)]
+        return rows[:, columns].astype(np.float64)
+
+    def _merge(self, rows, sign):
+        for ind in range(len(self.pairs)):
+            x = rows[:, 2 * ind + 1]
+            y = rows[:, 2 * ind + 2]
+            valid = np.isfinite(x) & np.isfinite(y)
+            for parity in (0, 1):
+                mask = valid & ((rows[:, 0] != 0) == parity)
+                batch = _moments(x[mask], y[mask])
+                if batch[0]:
+                    self._moments[ind][parity] = _combine(self._moments[ind][parity], batch, sign)
+
+    def _rebuild_moments(self):
+        self._moments = [[_NO_MOMENTS, _NO_MOMENTS] for _ in self.pairs]
+        self._merge(self._rows[self._window.slots()], 1)
+        self._num_updates = 0
+
+    def clear(self):
+        self._window.clear()
+
+    def update(self, buffer):
+        """Update statistics with the rows appended to the buffer since the previous update."""
+        rebuilt, rows, slots, dropped = self._window.update(buffer)
+        rows = self._select(rows)
+        if rebuilt:
+            self._rows = np.full((buffer.maxlen, rows.shape[1]), np.nan)
+            self._rows[slots] = rows
+            self._rebuild_moments()
+            return
+
+        if not len(rows):
+            return
+
+        self._merge(self._rows[dropped], -1)
+        self._merge(rows, 1)
+        self._rows[slots] = rows
+
+        # rebuild from the stored rows once the whole window has been replaced, so that rounding
+        # errors of subtractions do not accumulate
+        self._num_updates += len(rows)
+        if self._num_updates >= buffer.maxlen:
+            self._rebuild_moments()
+
+    def __len__(self):
+        return len(self._window)
+
+    def get(self, pair_ind, parity=None):
+        """Return statistics of a column pair.
+
+        Args:
+            pair_ind (int): index of the column pair
+            parity (int, optional): 0 for even, 1 for odd shots, None for all shots
+
+        Returns:
+            PairStats: number of shots, means, standard deviations, covariance, Pearson
+                correlation coefficient and least-squares slope of y over x, NaN if undefined
+        """
+        if self._moments is None:
+            return PairStats(0, *[np.nan] * 7)
+
+        if parity is None:
+            even, odd = self._moments[pair_ind]
+            moments = _combine(even, odd, 1) if even[0] and odd[0] else (even if even[0] else odd)
+        else:
+            moments = self._moments[pair_ind][parity]
+
+        n, mean_x, mean_y, m2_x, m2_y, c_xy = moments
+        if not n:
+            return PairStats(0, *[np.nan] * 7)
+
+        # accumulated rounding errors can make sums of squares slightly negative
+        m2_x = max(m2_x, 0.0)
+        m2_y = max(m2_y, 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return PairStats(
+                n=n,
+                mean_x=mean_x,
+                mean_y=mean_y,
+                std_x=np.sqrt(m2_x / n),
+                std_y=np.sqrt(m2_y / n),
+                cov=c_xy / n,
+                r=np.float64(c_xy) / np.sqrt(m2_x * m2_y),
+                slope=np.float64(c_xy) / m2_x,
+            )
+
+
+def format_stats(rolling_stats, pair_ind):
+    """Return a short text with even and odd shot statistics of a column pair for plot titles."""
+    lines = []
+    for parity, label in enumerate(("even", "odd")):
+        s = rolling_stats.get(pair_ind, parity)
+        lines.append(
+            f"{label}: x = {s.mean_x:.4g} ± {s.std_x:.3g}, y = {s.mean_y:.4g} ± {s.std_y:.3g}, "
+            f"r = {s.r:.3f}, slope = {s.slope:.3g}"
+        )
+    return "\n".join(lines)
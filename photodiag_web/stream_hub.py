@@ -0,0 +1,160 @@
+import logging
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+import bsread
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A view on a shared bsread stream, mimicking the `bsread.source` interface.
+
+    Messages are fanned out by the hub into a bounded per-subscription queue. If a subscriber
+    falls behind, the oldest messages are dropped so that it always sees the latest data.
+    """
+
+    def __init__(self, hub, key, maxsize):
+        self._hub = hub
+        self._key = key
+        self._queue = Queue(maxsize=maxsize)
+        self.error = None
+        self.num_dropped = 0
+
+    def _put(self, message):
+        while True:
+            try:
+                self._queue.put_nowait(message)
+                return
+            except Full:
+                try:
+                    self._queue.get_nowait()
+                    self.num_dropped += 1
+                except Empty:
+                    pass
+
+    def receive(self, timeout=1):
+        """Return the next bsread message or None if nothing arrived within the timeout.
+
+        Raises the exception of the underlying stream, if it has failed.
+        """
+        if self.error is not None:
+            raise self.error
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            if self.error is not None:
+                raise self.error
+            return None
+
+    def close(self):
+        self._hub._unsubscribe(self._key, self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class _SharedStream:
+    def __init__(self, channels):
+        self.channels = channels
+        self.subscriptions = []
+        self.thread = None
+
+
+class StreamHub:
+    """Process-wide bsread acquisition hub.
+
+    Holds a single bsread subscription per channel set, no matter how many sessions and panels
+    request it, and fans out pulse-aligned messages to all subscribers. A stream is opened with
+    its first subscriber and closed after its last subscriber leaves.
+    """
+
+    def __init__(self, source_factory=bsread.source, queue_size=1000):
+        self.source_factory = source_factory
+        self.queue_size = queue_size
+        self._streams = {}
+        self._lock = Lock()
+
+    def source(self, channels):
+        """Subscribe to a set of channels.
+
+        Args:
+            channels (Iterable): bsread channel names
+
+        Returns:
+            Subscription: a context manager with a `receive` method, similar to `bsread.source`
+        """
+        key = tuple(sorted(set(channels)))
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is None:
+                shared = _SharedStream(key)
+                self._streams[key] = shared
+
+            subscription = Subscription(self, key, self.queue_size)
+            shared.subscriptions.append(subscription)
+
+            if shared.thread is None:
+                shared.thread = Thread(target=self._run, args=(shared,), daemon=True)
+                shared.thread.start()
+
+        return subscription
+
+    def _unsubscribe(self, key, subscription):
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is None or subscription not in shared.subscriptions:
+                return
+
+            shared.subscriptions.remove(subscription)
+            if not shared.subscriptions:
+                # the reader thread stops once it sees that it is no longer registered
+                del self._streams[key]
+
+    def _is_active(self, shared):
+        with self._lock:
+            return self._streams.get(shared.channels) is shared
+
+    def _run(self, shared):
+        try:
+            with self.source_factory(
+                channels=list(shared.channels), receive_timeout=1000
+            ) as stream:
+                while self._is_active(shared):
+                    message = stream.receive()
+                    if message is None:
+                        continue
+
+                    with self._lock:
+                        subscriptions = list(shared.subscriptions)
+
+                    for subscription in subscriptions:
+                        subscription._put(message)
+
+        except Exception as e:
+            logger.error(e)
+            with self._lock:
+                if self._streams.get(shared.channels) is shared:
+                    del self._streams[shared.channels]
+                subscriptions = list(shared.subscriptions)
+
+            for subscription in subscriptions:
+                subscription.error = e
+
+    @property
+    def num_streams(self):
+        with self._lock:
+            return len(self._streams)
+
+    def num_subscribers(self, channels):
+        key = tuple(sorted(set(channels)))
+        with self._lock:
+            shared = self._streams.get(key)
+            return len(shared.subscriptions) if shared is not None else 0
+
+
+stream_hub = StreamHub()
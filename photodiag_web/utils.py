@@ -1,15 +1,13 @@
-import os
-import tempfile
+import logging
 import time
+from bisect import bisect_left, bisect_right, insort
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
 
-import elog
 import epics
 import numpy as np
-import urllib3
-from bokeh.io import export_png
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)  # suppress elog warning
 
+logger = logging.getLogger(__name__)
 
 DEVICES = [
     "SARFE10-PBPS053",
@@ -39,73 +37,368 @@ SPECT_DEV_CONFIG = {
 }
 
 
-def _make_arrays(pvs, n_pulses):
-    arrays = []
-    for pv in pvs:
-        val = pv.value
+def epics_collect_data(channels, n_pulses=100, timeout=60, align=True, tolerance=0.002):
+    """Collect a number of consecutive values of EPICS channels.
+
+    PVs are taken from the pyepics cache, so channels that were already connected are reused.
+
+    Args:
+        channels (Iterable): EPICS channel names
+        n_pulses (int, optional): number of values to collect per channel, defaults to 100
+        timeout (float, optional): maximum waiting time in seconds, defaults to 60
+        align (bool, optional): align values of all channels on their EPICS timestamps (= pulses),
+            otherwise take the first n_pulses values of each channel. Defaults to True.
+        tolerance (float, optional): maximum difference in seconds between timestamps of values
+            of the same pulse, as channels served by different IOCs are not timestamped
+            identically. It should be less than half of the pulse period. Defaults to 0.002.
+
+    Returns:
+        list: an array of n_pulses values for each of the channels
+
+    Raises:
+        TimeoutError: if not enough values were received within the timeout
+    """
+    channels = list(channels)
+    pvs = [epics.get_pv(ch) for ch in channels]
+
+    lock = Lock()
+    done = Event()
+    counters = [0] * len(channels)
+    # values of incomplete pulses per key (timestamp of the first value or a counter)
+    pending = {}
+    pending_keys = []
+    complete = []
+
+    def _timestamp_key(timestamp):
+        if complete and timestamp < complete[-1][0]:
+            # the pulse can not be completed anymore
+            return None
+
+        i = bisect_left(pending_keys, timestamp)
+        neighbours = pending_keys[max(i - 1, 0) : i + 1]
+        if neighbours:
+            key = min(neighbours, key=lambda k: abs(k - timestamp))
+            if abs(key - timestamp) <= tolerance:
+                return key
+
+        insort(pending_keys, timestamp)
+        return timestamp
+
+    def on_value_change(ichannel=None, value=None, timestamp=None, **_):
+        with lock:
+            if done.is_set():
+                return
+
+            if align:
+                key = _timestamp_key(timestamp)
+                if key is None:
+                    return
+            else:
+                key = counters[ichannel]
+                counters[ichannel] += 1
+
+            values = pending.setdefault(key, {})
+            if ichannel in values:
+                return
+
+            values[ichannel] = np.array(value)
+            if len(values) < len(channels):
+                return
+
+            complete.append((key, [values[i] for i in range(len(channels))]))
+            del pending[key]
+            if align:
+                # monitors deliver values of a channel in order, so incomplete pulses older than
+                # a complete one would never be completed
+                i = bisect_right(pending_keys, key)
+                for old_key in pending_keys[:i]:
+                    pending.pop(old_key, None)
+                del pending_keys[:i]
+
+            if len(complete) == n_pulses:
+                done.set()
+
+    callback_inds = [
+        pv.add_callback(callback=on_value_change, ichannel=i) for i, pv in enumerate(pvs)
+    ]
 
-        dtype = val.dtype if isinstance(val, np.ndarray) else type(val)
-        shape = val.shape if isinstance(val, np.ndarray) else tuple()
-        shape = (n_pulses,) + shape
+    try:
+        if not done.wait(timeout):
+            raise TimeoutError(
+                f"Only {len(complete)} out of {n_pulses} values of {channels} were received "
+                f"within {timeout} s"
+            )
+    finally:
+        for pv, ind in zip(pvs, callback_inds):
+            pv.remove_callback(ind)
 
-        arr = np.empty(shape, dtype)
-        arrays.append(arr)
+    if align:
+        complete.sort(key=lambda item: item[0])
+    return [np.array([vals[i] for _, vals in complete]) for i in range(len(channels))]
 
-    return arrays
 
+def epics_put_many(values, timeout=10):
+    """Write values to EPICS channels concurrently and wait for all puts to complete.
 
-def epics_collect_data(channels, n_pulses=100):
-    pvs = [epics.PV(ch) for ch in channels]
-    counters = np.zeros(len(channels), dtype=int)
+    All PVs connect and all puts are issued in parallel, so the total time is about a single
+    round-trip instead of the sum of all put latencies.
 
-    arrays = _make_arrays(pvs, n_pulses)
+    Args:
+        values (dict): EPICS channel names and values to write
+        timeout (float, optional): maximum waiting time in seconds for all puts, defaults to 10
+
+    Returns:
+        dict: channel names and error messages of failed puts, empty if all puts succeeded
+    """
+    deadline = time.monotonic() + timeout
+    pvs = {ch: epics.get_pv(ch) for ch in values}
 
-    def on_value_change(pv=None, ichannel=None, value=None, **_):
-        ivalue = counters[ichannel]
-        arrays[ichannel][ivalue] = value
+    failed = {}
+    completed = {}
+    for ch, pv in pvs.items():
+        if not pv.wait_for_connection(timeout=max(deadline - time.monotonic(), 0)):
+            failed[ch] = "not connected"
+            continue
 
-        counters[ichannel] += 1
+        done = Event()
+        try:
+            pv.put(values[ch], callback=lambda done=done, **_: done.set())
+        except Exception as e:
+            failed[ch] = str(e)
+            continue
 
-        if counters[ichannel] == n_pulses:
-            pv.disconnect()
+        completed[ch] = done
 
-    for i, pv in enumerate(pvs):
-        pv.add_callback(callback=on_value_change, pv=pv, ichannel=i)
+    for ch, done in completed.items():
+        if not done.wait(max(deadline - time.monotonic(), 0)):
+            failed[ch] = f"put not completed within {timeout} s"
 
-    while not np.all(counters == n_pulses):
-        time.sleep(0.5)
+    return failed
 
-    return arrays
 
+class RingBuffer:
+    """Preallocated ring buffer of scalars or fixed size rows of scalars.
 
-def push_elog(figures, message, attributes):
-    """Push an entry to elog at https://elog-gfa.psi.ch/SF-Photonics-Data.
+    Every row is written twice, at `i` and `i + maxlen`, so that the retained rows can always be
+    returned in order as a single contiguous view without copying. It is safe to have one writer
+    thread and any number of reader threads without locking. Note that a returned view is backed
+    by the buffer, so its oldest rows get overwritten as soon as new data is appended.
 
     Args:
-        figures (Iterable): an Iterable of tuples of bokeh Plot instances and a corresponding file
-            names
-        message (str): elog entry message text
-        attributes (dict): elog entry attributes dictionary
+        maxlen (int): maximum number of rows
+        num_columns (int, optional): number of columns per row, None for a buffer of scalars
+        dtype (data-type, optional): data type of the buffer, defaults to float64
     """
-    logbook = elog.open(
-        "https://elog-gfa.psi.ch/SF-Photonics-Data", user="sf-photodiag", password=""
-    )
-
-    attachments = []
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for figure, figure_name in figures:
-            figure_path = os.path.join(temp_dir, figure_name)
-            export_png(figure, filename=figure_path)
-            attachments.append(figure_path)
-
-        msg_id = logbook.post(
-            message,
-            attributes=attributes,
-            attachments=attachments,
-            suppress_email_notification=True,
-        )
-
-    return msg_id
+
+    def __init__(self, maxlen, num_columns=None, dtype=np.float64):
+        if maxlen < 1:
+            raise ValueError("Ring buffer length should be positive")
+
+        self.maxlen = maxlen
+        self._count = 0
+        self._data = None
+
+        row_shape = tuple() if num_columns is None else (num_columns,)
+        self._allocate(row_shape, dtype)
+
+    def _allocate(self, row_shape, dtype):
+        self._data = np.zeros((2 * self.maxlen, *row_shape), dtype=dtype)
+        self._count = 0
+
+    def append(self, row):
+        """Append a row to the buffer, overwriting the oldest one if the buffer is full."""
+        ind = self._count % self.maxlen
+        self._data[ind] = row
+        self._data[ind + self.maxlen] = row
+        # publish the new row only after it has been completely written
+        self._count += 1
+
+    def clear(self):
+        self._count = 0
+
+    @property
+    def count(self):
+        """Total number of rows appended since the buffer was created or cleared."""
+        return self._count
+
+    def __len__(self):
+        return min(self._count, self.maxlen)
+
+    def view(self, start=None, stop=None):
+        """Return the retained rows in order of arrival as a zero-copy view.
+
+        Args:
+            start (int, optional): absolute index of the first row (see `count`), clipped to the
+                oldest retained row
+            stop (int, optional): absolute index past the last row, defaults to `count`
+
+        Returns:
+            ndarray: rows between start and stop
+        """
+        data = self._data
+        count = self._count
+        oldest = max(count - self.maxlen, 0)
+
+        start = oldest if start is None else max(start, oldest)
+        stop = count if stop is None else min(stop, count)
+        if data is None or start >= stop:
+            return data[:0] if data is not None else np.empty(0)
+
+        first = start % self.maxlen
+        return data[first : first + stop - start]
+
+
+class RingBufferWindow:
+    """Follow the rows retained in a `RingBuffer` for incremental computations over them.
+
+    `update` returns the rows appended to the buffer since the previous update, and the slots of
+    rows dropped from it in the meantime, so that per-row state kept in arrays of `maxlen` slots
+    (indexed by the absolute row index modulo `maxlen`) can be added and subtracted. It is safe
+    to use with a concurrent writer thread: the buffer count is read once, rows are copied, and
+    rows that got overwritten during the copy are discarded.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.start = 0
+        self.stop = 0
+
+    def clear(self):
+        self.buffer = None
+        self.start = 0
+        self.stop = 0
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def _snapshot(self, buffer, start, stop):
+        rows = buffer.view(start, stop).copy()
+        start = stop - len(rows)
+        # the writer might have overwritten the oldest rows during the copy
+        num_torn = min(max(buffer.count - buffer.maxlen - start, 0), len(rows))
+        return start + num_torn, rows[num_torn:]
+
+    def update(self, buffer):
+        """Follow the buffer up to its current count.
+
+        The window is rebuilt from all retained rows, if the buffer was replaced or cleared, or
+        rows were overwritten before they could be returned.
+
+        Returns:
+            tuple: whether the window was rebuilt, a copy of new rows (all retained rows on a
+                rebuild), slots of new rows, and slots of dropped rows
+        """
+        count = buffer.count
+        maxlen = buffer.maxlen
+        if buffer is self.buffer and self.stop <= count:
+            start, rows = self._snapshot(buffer, self.stop, count)
+            if start == self.stop:
+                new_start = max(self.start, count - maxlen)
+                dropped = np.arange(self.start, new_start) % maxlen
+                self.start, self.stop = new_start, count
+                return False, rows, np.arange(start, count) % maxlen, dropped
+
+        start, rows = self._snapshot(buffer, None, count)
+        self.buffer = buffer
+        self.start, self.stop = start, count
+        return True, rows, np.arange(start, count) % maxlen, np.empty(0, dtype=np.int64)
+
+    def slots(self):
+        """Return slots of all rows in the window."""
+        return np.arange(self.start, self.stop) % self.buffer.maxlen
+
+    def retained(self):
+        """Return a copy of rows in the window, that are still retained, and their slots."""
+        start, rows = self._snapshot(self.buffer, self.start, self.stop)
+        return rows, np.arange(start, self.stop) % self.buffer.maxlen
+
+
+class WaveformRingBuffer(RingBuffer):
+    """Preallocated ring buffer of waveforms (1D arrays), see `RingBuffer`.
+
+    The buffer is allocated on the first append based on the length and dtype of the waveform,
+    and is reallocated (dropping previous waveforms) if the waveform length changes.
+
+    Args:
+        maxlen (int): maximum number of waveforms
+        dtype (data-type, optional): data type of the buffer, defaults to the waveform dtype
+    """
+
+    def __init__(self, maxlen, dtype=None):
+        if maxlen < 1:
+            raise ValueError("Ring buffer length should be positive")
+
+        self.maxlen = maxlen
+        self.dtype = dtype
+        self._count = 0
+        self._data = None
+
+    def append(self, row):
+        row = np.asarray(row)
+        if self._data is None or self._data.shape[1:] != row.shape:
+            self._allocate(row.shape, row.dtype if self.dtype is None else self.dtype)
+
+        super().append(row)
+
+
+class CallbackQueue:
+    """Process PV monitor values in a consumer thread instead of the pyepics callback thread.
+
+    `put` is meant to be registered as a pyepics callback, it only enqueues the value into a
+    bounded queue, so that Channel Access delivery is never blocked. The consumer thread calls
+    `func` with each value. If it can not keep up, the oldest values are dropped and counted in
+    `num_dropped`.
+
+    Args:
+        func (callable): called with each value in the consumer thread
+        maxsize (int, optional): maximum number of queued values, defaults to 100
+    """
+
+    def __init__(self, func, maxsize=100):
+        self.func = func
+        self.num_dropped = 0
+        self._queue = Queue(maxsize=maxsize)
+        self._stop_event = None
+
+    def put(self, value, **_):
+        while True:
+            try:
+                self._queue.put_nowait(value)
+                return
+            except Full:
+                try:
+                    self._queue.get_nowait()
+                    self.num_dropped += 1
+                except Empty:
+                    pass
+
+    def start(self):
+        self._stop_event = Event()
+        Thread(target=self._run, args=(self._stop_event,), daemon=True).start()
+
+    def stop(self):
+        """Stop the consumer thread without waiting for it, queued values are discarded."""
+        if self._stop_event is not None:
+            self._stop_event.set()
+            self._stop_event = None
+
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                break
+
+    def _run(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                value = self._queue.get(timeout=0.5)
+            except Empty:
+                continue
+
+            try:
+                self.func(value)
+            except Exception as e:
+                logger.error(e)
 
 
 def get_device_domain(device_name):